@@ -1,10 +1,17 @@
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
 from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
 from qwen_vl_utils import process_vision_info
 from PIL import Image
 import torch
 import io
+import os
+import time
+import uuid
+import asyncio
 import uvicorn
 
 app = FastAPI()
@@ -32,11 +39,80 @@ device = "cuda" if torch.cuda.is_available() else "cpu"
 model = model.to(device)
 print(f"Model loaded on {device}")
 
-@app.post("/convert")
-async def convert_image_to_latex(file: UploadFile = File(...)):
-    # Read and process the uploaded image
-    contents = await file.read()
-    image = Image.open(io.BytesIO(contents)).convert("RGB")
+# Admission control (the model is resident; this budgets per-request activations)
+ADMISSION_BUDGET_MB = float(os.environ.get("OCR_ADMISSION_MB", "4096"))
+MAX_QUEUE = int(os.environ.get("OCR_MAX_QUEUE", "32"))  # reject with 503 beyond this many waiting
+BASE_MB = 512.0  # generation KV cache and workspace for max_new_tokens
+MB_PER_MEGAPIXEL = 600.0  # vision tokens and their activations grow with image area
+
+
+# Same controller as in modules/docker_tts/server.py: each image is built from its own
+# directory (COPY . .), so the two servers cannot import a shared module.
+class AdmissionController:
+    """
+    Admits requests against a memory budget in arrival order.
+    
+    A request waits until it is first in line and its estimated cost fits in
+    what is left of the budget; one larger than the whole budget runs alone.
+    Tickets are strings so clients can look up their place in line.
+    """
+    
+    def __init__(self, budget_mb):
+        self.budget_mb = budget_mb
+        self.in_use_mb = 0.0
+        self.active = 0
+        self._waiting = []  # tickets in arrival order
+        self._running = set()
+        self._cond = asyncio.Condition()
+    
+    @asynccontextmanager
+    async def admit(self, ticket, cost_mb):
+        async with self._cond:
+            self._waiting.append(ticket)
+            try:
+                await self._cond.wait_for(lambda: self._waiting[0] == ticket and self._fits(cost_mb))
+            finally:
+                # Also reached when the client disconnects while queued
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+            self.in_use_mb += cost_mb
+            self.active += 1
+            self._running.add(ticket)
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.in_use_mb -= cost_mb
+                self.active -= 1
+                self._running.discard(ticket)
+                self._cond.notify_all()
+    
+    def waiting(self):
+        return len(self._waiting)
+    
+    def position(self, ticket):
+        """1-based place in line, 0 once running, None for an unknown ticket."""
+        if ticket in self._running:
+            return 0
+        if ticket in self._waiting:
+            return self._waiting.index(ticket) + 1
+        return None
+    
+    def _fits(self, cost_mb):
+        return self.active == 0 or self.in_use_mb + cost_mb <= self.budget_mb
+
+
+ADMISSION = AdmissionController(ADMISSION_BUDGET_MB)
+
+
+def estimate_cost_mb(image):
+    """Estimate a request's peak memory from the image size (read from its header)."""
+    width, height = image.size
+    return BASE_MB + width * height / 1e6 * MB_PER_MEGAPIXEL
+
+
+def image_to_latex(image):
+    image = image.convert("RGB")
     
     # Prepare messages
     messages = [
@@ -79,7 +155,59 @@ async def convert_image_to_latex(file: UploadFile = File(...)):
         clean_up_tokenization_spaces=True
     )
     
-    return {"latex": output_text[0]}
+    return output_text[0]
+
+
+@app.post("/convert")
+async def convert_image_to_latex(file: UploadFile = File(...), ticket: str = Form(None)):
+    """
+    Convert an image to LaTeX.
+    
+    `ticket` is an optional client-chosen id; while this request is queued,
+    GET /queue/?ticket=<id> reports its position.
+    """
+    if ADMISSION.waiting() >= MAX_QUEUE:
+        return JSONResponse({"error": "OCR queue is full", "queue_position": ADMISSION.waiting() + 1},
+                            status_code=503, headers={"Retry-After": "10"})
+    ticket = ticket or uuid.uuid4().hex
+    if ADMISSION.position(ticket) is not None:
+        return JSONResponse({"error": "Ticket already in use"}, status_code=409)
+    
+    # Read the upload; Image.open only parses the header until the pixels are needed
+    contents = await file.read()
+    image = Image.open(io.BytesIO(contents))
+    
+    queued_at = time.time()
+    arrival_position = ADMISSION.waiting() + 1
+    async with ADMISSION.admit(ticket, estimate_cost_mb(image)):
+        waited = time.time() - queued_at
+        latex = await run_in_threadpool(image_to_latex, image)
+    
+    return JSONResponse({"latex": latex},
+                        headers={"X-Queue-Ticket": ticket, "X-Queue-Position": str(arrival_position),
+                                 "X-Queue-Wait": f"{waited:.2f}"})
+
+@app.get("/queue/")
+async def queue_status(ticket: str = None):
+    """
+    Requests waiting and running, and the memory they have reserved.
+    
+    With `ticket` (as sent to /convert) also the request's queue_position:
+    its place in line, or 0 once running. Unknown tickets (not yet uploaded,
+    or finished) get a 404.
+    """
+    status = {
+        "waiting": ADMISSION.waiting(),
+        "running": ADMISSION.active,
+        "in_use_mb": round(ADMISSION.in_use_mb, 1),
+        "budget_mb": ADMISSION.budget_mb,
+    }
+    if ticket is not None:
+        position = ADMISSION.position(ticket)
+        if position is None:
+            return JSONResponse({**status, "ticket": ticket, "message": "Unknown ticket"}, status_code=404)
+        status.update(ticket=ticket, queue_position=position)
+    return status
 
 @app.get("/")
 async def root():
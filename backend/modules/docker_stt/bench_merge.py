@@ -0,0 +1,139 @@
+"""
+Micro-benchmark for merge_segments_from_chunks on synthetic segment lists.
+
+    python bench_merge.py --hours 3
+
+Compares the sweep-line merge against the previous quadratic merge and checks
+that both keep the same segments. The synthetic chunks transcribe one stream
+of timed words, each chunk splitting it into segments at its own boundaries,
+so the overlaps leave partial duplicates; dedup_words then runs on the merged
+segments the way it runs after alignment, and the surviving words are checked
+against the stream (repeated words before and after, words lost).
+"""
+import argparse
+import random
+import time
+
+from segments import merge_segments_from_chunks, dedup_words, shift_segment
+
+WORD_JITTER = 0.05  # seconds; the two alignments of a repeated word differ by up to twice this
+
+
+def quadratic_merge(chunk_results):
+    """Previous O(n²) merge, kept as the reference implementation."""
+    all_segments = []
+    for segments, chunk_offset in chunk_results:
+        for seg in segments:
+            all_segments.append(shift_segment(seg, chunk_offset))
+
+    merged_segments = []
+    for seg in all_segments:
+        is_duplicate = False
+        for existing in merged_segments:
+            overlap_start = max(seg['start'], existing['start'])
+            overlap_end = min(seg['end'], existing['end'])
+            overlap_duration = max(0, overlap_end - overlap_start)
+            if overlap_duration > 0.8 * (seg['end'] - seg['start']):
+                is_duplicate = True
+                break
+        if not is_duplicate:
+            merged_segments.append(seg)
+
+    merged_segments.sort(key=lambda x: x['start'])
+    return merged_segments
+
+
+def synthetic_words(duration, rng):
+    """One stream of timed words (w0, w1, ...) with pauses, like a lecture."""
+    words = []
+    t = rng.uniform(0.0, 1.0)
+    while t < duration - 0.5:
+        length = rng.uniform(0.15, 0.5)
+        words.append({"word": f"w{len(words)}", "start": t, "end": t + length, "score": 0.9})
+        t += length + (rng.uniform(0.5, 2.0) if rng.random() < 0.05 else rng.uniform(0.02, 0.2))
+    return words
+
+
+def synthetic_chunk_results(duration, chunk_length=30.0, stride=5.0, seed=0):
+    """
+    Build (segments, chunk_start) tuples resembling chunked Whisper output.
+
+    Each chunk holds the words of the stream that lie inside it, split into
+    segments at its own random boundaries, with times relative to the chunk
+    and jittered by WORD_JITTER.
+    """
+    rng = random.Random(seed)
+    stream = synthetic_words(duration, rng)
+    chunk_results = []
+    start = 0.0
+    first = 0
+    while start < duration:
+        end = min(start + chunk_length, duration)
+        while first < len(stream) and stream[first]["start"] < start:
+            first += 1
+        segments = []
+        current = []
+        i = first
+        while i < len(stream) and stream[i]["end"] <= end:
+            jitter = rng.uniform(-WORD_JITTER, WORD_JITTER)
+            word = dict(stream[i], start=stream[i]["start"] - start + jitter, end=stream[i]["end"] - start + jitter)
+            if current and (word["start"] - current[-1]["end"] > 0.5 or rng.random() < 0.08):
+                segments.append(_segment(current))
+                current = []
+            current.append(word)
+            i += 1
+        if current:
+            segments.append(_segment(current))
+        chunk_results.append((segments, start))
+        if end >= duration:
+            break
+        start += chunk_length - stride
+    return chunk_results
+
+
+def _segment(words):
+    return {"start": words[0]["start"], "end": words[-1]["end"],
+            "text": " " + " ".join(w["word"] for w in words), "words": words}
+
+
+def word_errors(segments):
+    """(repeated, lost) words of the merged output against the synthetic stream."""
+    indices = [int(w["word"][1:]) for seg in segments for w in seg["words"]]
+    unique = set(indices)
+    return len(indices) - len(unique), max(unique) + 1 - len(unique)
+
+
+def timed(func, *args):
+    t0 = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hours", type=float, nargs="+", default=[0.5, 1.0, 3.0])
+    parser.add_argument("--skip-reference", action="store_true", help="do not run the quadratic merge")
+    args = parser.parse_args()
+
+    for hours in args.hours:
+        chunk_results = synthetic_chunk_results(hours * 3600)
+        n_segments = sum(len(segments) for segments, _ in chunk_results)
+
+        merged, sweep_time = timed(merge_segments_from_chunks, chunk_results)
+        deduped, dedup_time = timed(dedup_words, merged)
+        line = f"{hours:>5.1f} h | {n_segments:>6} segments -> {len(merged):>6} | sweep {sweep_time * 1000:8.1f} ms"
+        repeated_before, _ = word_errors(merged)
+        repeated, lost = word_errors(deduped)
+        line += (f" | dedup {dedup_time * 1000:6.1f} ms, repeated words {repeated_before} -> {repeated},"
+                 f" lost {lost}")
+
+        if not args.skip_reference:
+            reference, ref_time = timed(quadratic_merge, chunk_results)
+            same = [(s['start'], s['end']) for s in merged] == [(s['start'], s['end']) for s in reference]
+            line += f" | quadratic {ref_time * 1000:9.1f} ms | x{ref_time / sweep_time:6.1f} | identical={same}"
+
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""
+CPU benchmark of the STT pipeline stages with deterministic stub models.
+
+    python bench_pipeline.py --hours 1 3 --chunk-length 30 --stride 5 --chunking fixed
+
+Synthetic lecture audio (speech bursts and pauses) is written to a raw
+float32 file and memory-mapped the way decode_audio maps long inputs, then
+run through:
+
+    transcribe_with_chunking    stub ASR instead of WhisperX
+    merge_segments_from_chunks  re-merge of the raw per-chunk segments
+    dedup_words                 word dedup of the merged segments (after alignment in server.py)
+    stitch_speakers             stub windowed diarization joined by SpeakerStitcher
+                                (fails unless it finds exactly --speakers speakers)
+    assign_word_speakers        all words against the stitched turns
+    assign_speakers             words and segments in one pass
+    render_srt / render_vtt     subtitle writers
+
+For each stage the wall time, real-time factor (stage time / audio time),
+throughput (audio seconds per second and items per second), peak traced
+allocation and process RSS are reported. Only numpy is needed. --no-audio
+skips the audio and benchmarks the segment stages on synthetic chunk results.
+"""
+import argparse
+import contextlib
+import io
+import mmap
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from bench_merge import synthetic_chunk_results
+from chunking import SAMPLE_RATE, CHUNKING_MODE, ASR_BATCH_SIZE, transcribe_with_chunking
+from segments import (
+    merge_segments_from_chunks, dedup_words, assign_word_speakers, assign_speakers, SpeakerStitcher,
+    render_srt, render_vtt,
+)
+
+WORDS_PER_SECOND = 2.5
+STUB_SEGMENT_SECONDS = 6.0  # stub ASR emits one segment per speech-bearing window of this length
+STUB_SPEECH_RMS = 0.01  # windows quieter than this are treated as silence by the stub
+STUB_PROFILE_SIZE = 24  # length of the stub voice profiles (like speaker_profiles in server.py)
+STUB_PROFILE_NOISE = 0.1  # per-window profile noise relative to the speaker's own profile
+
+
+class StubWhisper:
+    """
+    Deterministic stand-in for a WhisperX model.
+
+    Emits one segment per STUB_SEGMENT_SECONDS window of the input that holds
+    speech, with evenly spaced words, so output depends only on the audio.
+    `cost` seconds of sleep per audio second simulate model compute.
+    """
+
+    def __init__(self, cost=0.0):
+        self.cost = cost
+        self.calls = 0
+
+    def transcribe(self, audio, batch_size=ASR_BATCH_SIZE, language=None):
+        self.calls += 1
+        window = int(STUB_SEGMENT_SECONDS * SAMPLE_RATE)
+        n_windows = -(-len(audio) // window)
+        padded = np.zeros(n_windows * window, dtype=np.float32)
+        padded[:len(audio)] = audio
+        rms = np.sqrt(np.square(padded.reshape(n_windows, window)).mean(axis=1))
+
+        segments = []
+        for i in np.flatnonzero(rms > STUB_SPEECH_RMS):
+            start = i * STUB_SEGMENT_SECONDS
+            end = min(start + STUB_SEGMENT_SECONDS, len(audio) / SAMPLE_RATE)
+            segments.append(stub_segment(start, end, f"{i}:{rms[i]:.4f}"))
+
+        if self.cost:
+            time.sleep(len(audio) / SAMPLE_RATE * self.cost)
+        return {"segments": segments, "language": language or "en"}
+
+
+def stub_segment(start, end, tag):
+    """Segment with words spread evenly over [start, end]."""
+    n_words = max(1, int((end - start) * WORDS_PER_SECOND))
+    step = (end - start) / n_words
+    words = [{"word": f"w{k}", "start": start + k * step, "end": start + (k + 0.8) * step, "score": 0.9}
+             for k in range(n_words)]
+    return {"start": start, "end": end, "text": " " + " ".join(w["word"] for w in words) + f" [{tag}]",
+            "words": words}
+
+
+def stub_diarization(duration, speakers, window=300.0, overlap=20.0, seed=0):
+    """
+    Turns of a deterministic conversation, produced window by window the way
+    diarize_turns sees them: each window uses its own (shuffled) labels and
+    has a noisy voice profile of each speaker.
+
+    Returns a list of (window_turns, window_start, window_end, profiles).
+    """
+    rng = random.Random(seed)
+    voices = [[rng.gauss(0.0, 1.0) for _ in range(STUB_PROFILE_SIZE)] for _ in range(speakers)]
+    turns = []
+    t = 0.0
+    while t < duration:
+        length = rng.uniform(3.0, 30.0)
+        turns.append((t, min(t + length, duration), rng.randrange(speakers)))
+        t += length + rng.uniform(0.0, 1.0)
+
+    windows = []
+    start = 0.0
+    while True:
+        end = min(start + window, duration)
+        labels = list(range(speakers))
+        rng.shuffle(labels)
+        window_turns = [{"start_time": max(s, start), "end_time": min(e, end), "speaker": f"speaker_{labels[k]}"}
+                        for s, e, k in turns if e > start and s < end]
+        profiles = {f"speaker_{labels[k]}": [v + rng.gauss(0.0, STUB_PROFILE_NOISE) for v in voices[k]]
+                    for k in {k for s, e, k in turns if e > start and s < end}}
+        windows.append((window_turns, start, end, profiles))
+        if end >= duration:
+            return windows
+        start = end - overlap
+
+
+def stitch_speakers(windows, speakers):
+    """Stitch the stub windows; fails unless every true speaker keeps one global label."""
+    stitcher = SpeakerStitcher()
+    for window_turns, start, end, profiles in windows:
+        stitcher.add(window_turns, start, end, profiles)
+    found = len(stitcher.speakers())
+    if found != speakers:
+        raise AssertionError(f"stitched {found} speakers, expected {speakers}")
+    return stitcher.result()
+
+
+def write_synthetic_audio(path, duration, seed=0, block_seconds=60):
+    """
+    Write lecture-like float32 audio: noise bursts with a syllable-rate
+    envelope separated by pauses of 0.2-2 s, block by block.
+    """
+    rng = np.random.default_rng(seed)
+    total = int(duration * SAMPLE_RATE)
+    block = block_seconds * SAMPLE_RATE
+    speaking = True
+    remaining = 0
+    with open(path, "wb") as f:
+        for first in range(0, total, block):
+            n = min(block, total - first)
+            envelope = np.empty(n, dtype=np.float32)
+            filled = 0
+            while filled < n:
+                if remaining == 0:
+                    speaking = not speaking
+                    seconds = rng.uniform(1.0, 12.0) if speaking else rng.uniform(0.2, 2.0)
+                    remaining = int(seconds * SAMPLE_RATE)
+                take = min(remaining, n - filled)
+                envelope[filled:filled + take] = 0.1 if speaking else 0.0005
+                filled += take
+                remaining -= take
+            t = np.arange(first, first + n, dtype=np.float32) / SAMPLE_RATE
+            envelope *= 0.6 + 0.4 * np.sin(2 * np.pi * 4.0 * t)
+            audio = rng.standard_normal(n, dtype=np.float32) * envelope
+            audio.tofile(f)
+
+
+def map_audio(path):
+    """Memory-map a raw float32 file like decode_audio does for long inputs."""
+    with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return np.frombuffer(mapping, dtype=np.float32)
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * mmap.PAGESIZE / (1024 ** 2)
+
+
+def measure(name, func, audio_seconds, count_items, trace_memory=True, verbose=False):
+    """Run `func` timed, then again under tracemalloc for its peak allocation."""
+    # The pipeline logs every chunk; keep the report readable unless asked
+    quiet = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with quiet:
+        t0 = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - t0
+        rss = rss_mb()
+
+        peak_mb = None
+        if trace_memory:
+            tracemalloc.start()
+            func()
+            peak_mb = tracemalloc.get_traced_memory()[1] / (1024 ** 2)
+            tracemalloc.stop()
+
+    items, unit = count_items(result)
+    row = {
+        "stage": name,
+        "seconds": elapsed,
+        "rtf": elapsed / audio_seconds,
+        "x_realtime": audio_seconds / elapsed if elapsed else float("inf"),
+        "items_per_s": items / elapsed if elapsed else float("inf"),
+        "unit": unit,
+        "peak_mb": peak_mb,
+        "rss_mb": rss,
+    }
+    return result, row
+
+
+def print_rows(rows):
+    print(f"{'stage':<27} {'time s':>9} {'RTF':>9} {'x realtime':>11} {'items/s':>13} "
+          f"{'peak MB':>8} {'RSS MB':>8}")
+    for row in rows:
+        peak = f"{row['peak_mb']:8.1f}" if row["peak_mb"] is not None else f"{'-':>8}"
+        print(f"{row['stage']:<27} {row['seconds']:9.3f} {row['rtf']:9.5f} {row['x_realtime']:11.0f} "
+              f"{row['items_per_s']:9.0f} {row['unit']:<3} {peak} {row['rss_mb']:8.1f}")
+
+
+def flatten_words(segments):
+    return [word for seg in segments for word in seg.get("words", [])]
+
+
+def bench(hours, args):
+    duration = hours * 3600
+    rows = []
+    trace = not args.no_memory
+
+    if args.no_audio:
+        chunk_results = [([stub_segment(s["start"], s["end"], "synthetic") for s in segments], offset)
+                         for segments, offset in synthetic_chunk_results(duration, args.chunk_length,
+                                                                         args.stride, args.seed)]
+    else:
+        fd, path = tempfile.mkstemp(suffix=".f32", prefix="bench_audio_")
+        os.close(fd)
+        try:
+            t0 = time.perf_counter()
+            write_synthetic_audio(path, duration, seed=args.seed)
+            print(f"  generated {duration / 3600:.1f} h of audio in {time.perf_counter() - t0:.1f}s")
+            audio = map_audio(path)
+            model = StubWhisper(cost=args.asr_cost)
+
+            result, row = measure(
+                "transcribe_with_chunking",
+                lambda: transcribe_with_chunking(
+                    audio, model, "cpu", chunk_length=args.chunk_length, stride=args.stride,
+                    language="en", batched=not args.unbatched, batch_size=args.batch_size,
+                    chunking=args.chunking),
+                duration, lambda r: (len(r["chunk_results"]), "chk"), trace, args.verbose)
+            rows.append(row)
+            chunk_results = result["chunk_results"]
+            del audio, result
+        finally:
+            os.remove(path)
+
+    segments, row = measure("merge_segments_from_chunks", lambda: merge_segments_from_chunks(chunk_results),
+                            duration, lambda r: (sum(len(s) for s, _ in chunk_results), "seg"), trace)
+    rows.append(row)
+
+    segments, row = measure("dedup_words", lambda: dedup_words(segments),
+                            duration, lambda r: (len(segments), "seg"), trace)
+    rows.append(row)
+
+    windows = stub_diarization(duration, args.speakers, seed=args.seed)
+    turns, row = measure("stitch_speakers", lambda: stitch_speakers(windows, args.speakers),
+                         duration, lambda r: (sum(len(w) for w, _, _, _ in windows), "trn"), trace)
+    rows.append(row)
+
+    words = flatten_words(segments)
+    _, row = measure("assign_word_speakers", lambda: assign_word_speakers(words, turns),
+                     duration, lambda r: (len(words), "wrd"), trace)
+    rows.append(row)
+
+    _, row = measure("assign_speakers", lambda: assign_speakers(segments, turns),
+                     duration, lambda r: (len(segments), "seg"), trace)
+    rows.append(row)
+
+    for name, render in (("render_srt", render_srt), ("render_vtt", render_vtt)):
+        _, row = measure(name, lambda: render(segments), duration, lambda r: (len(segments), "seg"), trace)
+        rows.append(row)
+
+    print(f"  {len(segments)} segments, {len(words)} words, {len(turns)} speaker turns")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hours", type=float, nargs="+", default=[0.5, 1.0, 3.0])
+    parser.add_argument("--chunk-length", type=float, default=30.0)
+    parser.add_argument("--stride", type=float, default=5.0, help="chunk overlap (fixed chunking)")
+    parser.add_argument("--chunking", choices=("vad", "fixed"), default=CHUNKING_MODE)
+    parser.add_argument("--batch-size", type=int, default=ASR_BATCH_SIZE)
+    parser.add_argument("--unbatched", action="store_true", help="one stub ASR call per chunk")
+    parser.add_argument("--asr-cost", type=float, default=0.0,
+                        help="simulated ASR seconds per audio second (0 measures pipeline overhead only)")
+    parser.add_argument("--speakers", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-audio", action="store_true", help="segment stages only, on synthetic chunk results")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own progress output")
+    args = parser.parse_args()
+
+    for hours in args.hours:
+        print(f"\n=== {hours:.1f} h | chunking={args.chunking} chunk_length={args.chunk_length}s "
+              f"stride={args.stride}s batch_size={args.batch_size} ===")
+        print_rows(bench(hours, args))
+
+
+if __name__ == "__main__":
+    main()
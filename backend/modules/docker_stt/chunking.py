@@ -0,0 +1,481 @@
+"""
+Audio chunking and chunked transcription for the STT server.
+
+Only numpy is needed here: the ASR model is passed in, so these functions can
+be run (and benchmarked) without the GPU stack server.py loads.
+"""
+import os
+import gc
+import time
+import bisect
+import threading
+import mmap
+from contextlib import contextmanager
+
+import numpy as np
+
+from segments import SegmentMerger
+
+SAMPLE_RATE = 16000
+
+# Chunking configuration
+CHUNK_LENGTH = 30.0  # 30 seconds per chunk (Whisper's optimal size)
+STRIDE = CHUNK_LENGTH / 6  # 5 seconds overlap to prevent word splitting
+
+# Voice-activity chunking configuration ("vad" cuts at silences, "fixed" uses STRIDE overlap)
+CHUNKING_MODE = os.environ.get("STT_CHUNKING", "vad")
+VAD_FRAME = 0.03  # 30 ms energy frames
+VAD_THRESHOLD_DB = -35.0  # speech if within 35 dB of the loud (95th percentile) frames
+VAD_FLOOR_DB = -60.0  # never treat frames quieter than this as speech
+VAD_MIN_SILENCE = 0.5  # silences shorter than this do not split speech
+VAD_MIN_SPEECH = 0.25  # drop speech blips shorter than this
+VAD_PAD = 0.2  # padding kept around each speech region
+VAD_MAX_GAP = 2.0  # silences longer than this are dropped between chunks
+VAD_CUT_SEARCH = 5.0  # window before the chunk limit searched for a quiet cut point
+
+# Batched inference configuration
+BATCHED_INFERENCE = os.environ.get("STT_BATCHED", "1") == "1"
+ASR_BATCH_SIZE = int(os.environ.get("STT_BATCH_SIZE", "16"))
+# Chunks in the first batched group; a small first group gets partial text (and
+# the detected language) out after one chunk instead of a full batch
+FIRST_GROUP_CHUNKS = int(os.environ.get("STT_FIRST_GROUP", "1"))
+
+# Multi-file batches: files transcribed side by side, sharing inference calls
+BATCH_FILES = int(os.environ.get("STT_BATCH_FILES", "4"))  # files of a batch transcribed at once
+BATCH_WAIT_SECONDS = 0.5  # how long a file's chunks wait for the other files' chunks
+FILE_GAP_SECONDS = CHUNK_LENGTH  # silence between pieces of a shared span, so VAD windows never straddle a time jump
+
+
+def release_pages(audio_array, start_sample, end_sample):
+    """
+    Drop the resident pages of a processed range of a memory-mapped buffer.
+    
+    The pages are re-read from the (unlinked) raw file if touched again, so
+    this only affects memory use. Takes the full buffer returned by
+    decode_audio; no-op for buffers held in RAM and for views.
+    """
+    # np.frombuffer(mapping) keeps the mmap behind a memoryview
+    mapping = getattr(audio_array.base, "obj", None)
+    if not isinstance(mapping, mmap.mmap):
+        return
+    first = (start_sample * 4) // mmap.PAGESIZE * mmap.PAGESIZE
+    last = min(end_sample * 4, len(mapping)) // mmap.PAGESIZE * mmap.PAGESIZE
+    if last > first:
+        mapping.madvise(mmap.MADV_DONTNEED, first, last - first)
+
+
+def create_audio_chunks(audio_array, sample_rate, chunk_length, stride):
+    """
+    Split audio into overlapping chunks.
+    
+    Args:
+        audio_array: numpy array of audio samples
+        sample_rate: audio sample rate (16000)
+        chunk_length: length of each chunk in seconds (30.0)
+        stride: overlap between chunks in seconds (5.0)
+    
+    Returns:
+        List of (chunk_audio, start_time, end_time) tuples
+    """
+    chunk_samples = int(chunk_length * sample_rate)
+    stride_samples = int(stride * sample_rate)
+    
+    chunks = []
+    total_samples = len(audio_array)
+    
+    start_sample = 0
+    while start_sample < total_samples:
+        end_sample = min(start_sample + chunk_samples, total_samples)
+        
+        chunk_audio = audio_array[start_sample:end_sample]
+        start_time = start_sample / sample_rate
+        end_time = end_sample / sample_rate
+        
+        chunks.append((chunk_audio, start_time, end_time))
+        
+        # Move to next chunk with stride overlap
+        start_sample += chunk_samples - stride_samples
+        
+        # If we've reached the end, break
+        if end_sample >= total_samples:
+            break
+    
+    return chunks
+
+
+def frame_energy_db(audio_array, frame_samples, block_frames=10000):
+    """Per-frame energy in dB, computed block by block to avoid a full-size copy."""
+    n_frames = len(audio_array) // frame_samples
+    energy = np.empty(n_frames, dtype=np.float32)
+    for first in range(0, n_frames, block_frames):
+        last = min(first + block_frames, n_frames)
+        block = np.asarray(audio_array[first * frame_samples:last * frame_samples], dtype=np.float32)
+        energy[first:last] = np.square(block).reshape(-1, frame_samples).mean(axis=1)
+        release_pages(audio_array, first * frame_samples, last * frame_samples)
+    return 10 * np.log10(energy + 1e-10)
+
+
+def detect_speech_regions(db, frame_length):
+    """
+    Find speech regions from frame energies.
+    
+    Returns:
+        List of (start_frame, end_frame) tuples, end exclusive
+    """
+    if len(db) == 0:
+        return []
+    
+    threshold = max(np.percentile(db, 95) + VAD_THRESHOLD_DB, VAD_FLOOR_DB)
+    speech = np.concatenate(([False], db > threshold, [False]))
+    edges = np.flatnonzero(np.diff(speech.astype(np.int8)))
+    
+    min_gap = int(VAD_MIN_SILENCE / frame_length)
+    min_speech = int(VAD_MIN_SPEECH / frame_length)
+    pad = int(VAD_PAD / frame_length)
+    
+    regions = []
+    for start, end in zip(edges[::2], edges[1::2]):
+        if regions and start - regions[-1][1] < min_gap:
+            regions[-1][1] = end
+        else:
+            regions.append([start, end])
+    
+    return [(max(start - pad, 0), min(end + pad, len(db)))
+            for start, end in regions if end - start >= min_speech]
+
+
+def create_vad_chunks(audio_array, sample_rate, chunk_length):
+    """
+    Split audio into chunks cut at silences, dropping non-speech regions.
+    
+    Consecutive speech regions are packed into chunks of at most
+    `chunk_length`; silences longer than VAD_MAX_GAP end a chunk. Regions longer than that are cut at the quietest frame
+    in the last VAD_CUT_SEARCH seconds before the limit, so no overlap is
+    needed.
+    
+    Returns:
+        List of (chunk_audio, start_time, end_time) tuples
+    """
+    frame_samples = int(VAD_FRAME * sample_rate)
+    db = frame_energy_db(audio_array, frame_samples)
+    regions = detect_speech_regions(db, VAD_FRAME)
+    
+    max_frames = int(chunk_length / VAD_FRAME)
+    search_frames = int(VAD_CUT_SEARCH / VAD_FRAME)
+    max_gap = int(VAD_MAX_GAP / VAD_FRAME)
+    
+    # Split regions that cannot fit in one chunk at quiet points
+    pieces = []
+    for start, end in regions:
+        while end - start > max_frames:
+            lo = start + max_frames - search_frames
+            cut = lo + int(np.argmin(db[lo:start + max_frames]))
+            pieces.append((start, cut))
+            start = cut
+        pieces.append((start, end))
+    
+    # Pack consecutive pieces into chunks, starting a new one after long silences
+    spans = []
+    for start, end in pieces:
+        if spans and end - spans[-1][0] <= max_frames and start - spans[-1][1] <= max_gap:
+            spans[-1][1] = end
+        else:
+            spans.append([start, end])
+    
+    chunks = []
+    for start, end in spans:
+        start_sample = start * frame_samples
+        end_sample = min(end * frame_samples, len(audio_array))
+        chunks.append((audio_array[start_sample:end_sample],
+                       start_sample / sample_rate, end_sample / sample_rate))
+    return chunks
+
+
+def group_chunks(chunks, group_size, first_size=None):
+    """
+    Group consecutive chunks into runs of at most `group_size` chunks.
+    
+    The first run holds at most `first_size` chunks when given.
+    """
+    first = min(first_size or group_size, group_size)
+    groups = [chunks[:first]] if chunks else []
+    groups.extend(chunks[i:i + group_size] for i in range(first, len(chunks), group_size))
+    return groups
+
+
+def transcribe_chunk_group(model, audio_array, sample_rate, group, batch_size, language=None):
+    """
+    Transcribe a run of consecutive chunks with a single inference call.
+    
+    Returns:
+        (list of (segments, chunk_start_time) tuples, detected language)
+    """
+    results, detected_language = transcribe_chunk_groups(model, [(audio_array, group)], sample_rate,
+                                                         batch_size, language=language)
+    return results[0], detected_language
+
+
+def transcribe_chunk_groups(model, parts, sample_rate, batch_size, language=None):
+    """
+    Transcribe chunk groups of one or more recordings with a single inference call.
+    
+    `parts` is a list of (audio_array, group) pairs. Touching or overlapping
+    chunks of a group are joined into contiguous pieces (chunks separated by
+    dropped silence stay separate pieces) and all pieces are passed to
+    WhisperX as one span, so the VAD windows of every chunk are packed into
+    shared batches of `batch_size`. Pieces are separated by FILE_GAP_SECONDS
+    of silence, so no VAD window (and thus no segment) spans a time jump
+    within a recording or two recordings. The resulting segments are split
+    back to the chunk containing their midpoint, with times relative to that
+    chunk's start.
+    
+    A span of one piece is passed as a view of the buffer. WhisperX needs one
+    contiguous array, so a span of several pieces is a copy: the pieces plus
+    their gaps, about group_size * (CHUNK_LENGTH + FILE_GAP_SECONDS) seconds
+    of float32 at most, freed when the call returns.
+    
+    Returns:
+        (per part, list of (segments, chunk_start_time) tuples; detected language)
+    """
+    gap = np.zeros(int(FILE_GAP_SECONDS * sample_rate), dtype=np.float32)
+    views = []
+    piece_starts = []  # (joined start, global start, part index) of each piece
+    offset = 0.0
+    for index, (audio_array, group) in enumerate(parts):
+        pieces = []
+        for _, start, end in group:
+            if pieces and start <= pieces[-1][1]:
+                pieces[-1][1] = max(pieces[-1][1], end)
+            else:
+                pieces.append([start, end])
+        for start, end in pieces:
+            if views:
+                views.append(gap)
+                offset += len(gap) / sample_rate
+            view = audio_array[int(start * sample_rate):int(end * sample_rate)]
+            views.append(view)
+            piece_starts.append((offset, start, index))
+            offset += len(view) / sample_rate
+    span_audio = views[0] if len(views) == 1 else np.concatenate(views)
+    
+    result = model.transcribe(span_audio, batch_size=batch_size, language=language)
+    
+    joined_starts = [joined for joined, _, _ in piece_starts]
+    chunk_starts = [[start for _, start, _ in group] for _, group in parts]
+    per_chunk = [[[] for _ in group] for _, group in parts]
+    for seg in result["segments"]:
+        joined_midpoint = (seg["start"] + seg["end"]) / 2
+        joined_start, global_start, index = piece_starts[
+            max(bisect.bisect_right(joined_starts, joined_midpoint) - 1, 0)]
+        to_global = global_start - joined_start
+        
+        starts = chunk_starts[index]
+        idx = max(bisect.bisect_right(starts, joined_midpoint + to_global) - 1, 0)
+        shift = to_global - starts[idx]
+        adjusted_seg = seg.copy()
+        adjusted_seg["start"] += shift
+        adjusted_seg["end"] += shift
+        per_chunk[index][idx].append(adjusted_seg)
+    
+    results = [list(zip(chunks, starts)) for chunks, starts in zip(per_chunk, chunk_starts)]
+    return results, result.get("language")
+
+
+class ChunkBatcher:
+    """
+    Coalesces chunk groups of files transcribed side by side into shared inference calls.
+    
+    Each file's transcription thread registers as a participant and hands its
+    chunk groups to transcribe(). A call is made once every participant has a
+    group waiting (or after BATCH_WAIT_SECONDS), by whichever thread gets
+    there first, and covers all waiting groups with the same model and
+    language. Groups without a language yet run alone so each file still
+    detects its own language.
+    """
+    
+    def __init__(self, n_files, batch_size=ASR_BATCH_SIZE, max_wait=BATCH_WAIT_SECONDS):
+        self.batch_size = batch_size
+        # Smaller per-file groups, so one shared call holds about batch_size chunks
+        self.group_size = max(1, batch_size // max(1, min(n_files, BATCH_FILES)))
+        self.max_wait = max_wait
+        self._participants = 0
+        self._pending = []  # requests in arrival order
+        self._busy = False
+        self._cond = threading.Condition()
+    
+    @contextmanager
+    def participant(self):
+        with self._cond:
+            self._participants += 1
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self._participants -= 1
+                self._cond.notify_all()
+    
+    def transcribe(self, model, audio_array, group, language=None):
+        """Same contract as transcribe_chunk_group, served from a shared call."""
+        request = {"model": model, "part": (audio_array, group), "language": language, "done": False}
+        deadline = time.time() + self.max_wait
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify_all()
+            while not request["done"]:
+                ready = len(self._pending) >= self._participants or time.time() >= deadline
+                if self._busy or not ready or not self._pending:
+                    self._cond.wait(timeout=max(deadline - time.time(), 0.05))
+                    continue
+                batch = self._take()
+                self._busy = True
+                self._cond.release()
+                try:
+                    self._run(batch)
+                finally:
+                    self._cond.acquire()
+                    self._busy = False
+                    self._cond.notify_all()
+        if "error" in request:
+            raise request["error"]
+        return request["result"], request["language_out"]
+    
+    def _take(self):
+        """Remove and return the oldest request plus those that can share its call."""
+        first = self._pending[0]
+        if first["language"] is None:
+            batch = [first]
+        else:
+            batch = [r for r in self._pending
+                     if r["model"] is first["model"] and r["language"] == first["language"]]
+        taken = {id(r) for r in batch}
+        self._pending = [r for r in self._pending if id(r) not in taken]
+        return batch
+    
+    def _run(self, batch):
+        try:
+            results, language = transcribe_chunk_groups(
+                batch[0]["model"], [r["part"] for r in batch], SAMPLE_RATE, self.batch_size,
+                language=batch[0]["language"])
+            print(f"🔀 Shared batch: {len(batch)} files, {sum(len(r['part'][1]) for r in batch)} chunks")
+            for request, result in zip(batch, results):
+                request["result"] = result
+                request["language_out"] = language
+        except Exception as e:
+            for request in batch:
+                request["error"] = e
+        for request in batch:
+            request["done"] = True
+
+
+def transcribe_with_chunking(audio_array, model, device, chunk_length=30.0, stride=5.0, language=None,
+                             batched=BATCHED_INFERENCE, batch_size=ASR_BATCH_SIZE, chunking=CHUNKING_MODE,
+                             on_segments=None, keep_chunk_results=True, batcher=None):
+    """
+    Transcribe audio file using chunking strategy.
+    
+    Args:
+        audio_array: decoded mono 16kHz float32 audio; chunks are views into it,
+            but a batched group of several pieces is copied for its call
+            (see transcribe_chunk_groups)
+        model: WhisperX model
+        device: cuda or cpu
+        chunk_length: length of each chunk in seconds
+        stride: overlap between chunks in seconds (fixed chunking only)
+        language: language code or None for auto-detect
+        batched: pack windows from up to `batch_size` chunks into one inference call
+        batch_size: number of windows per inference batch
+        chunking: "vad" to cut at silences, "fixed" for chunk_length/stride windows
+        on_segments: called with (new_segments, chunks_done, total_chunks) as chunks finish;
+            batched, once per group (FIRST_GROUP_CHUNKS chunks first, then full groups)
+        keep_chunk_results: keep raw per-chunk segments (for the stage cache); when
+            False they are released as soon as they are merged
+        batcher: ChunkBatcher shared with other files of a batch; chunk groups
+            are then transcribed in inference calls shared with those files
+    
+    Returns:
+        dict with merged 'segments', raw per-chunk 'chunk_results' and 'language'
+    """
+    sample_rate = SAMPLE_RATE
+    duration = len(audio_array) / sample_rate
+    
+    print(f"📊 Audio duration: {duration:.2f}s")
+    
+    # Create chunks
+    if 0 < duration <= chunk_length:
+        # Fits in one window: no chunking, VAD or merging needed
+        chunks = [(audio_array, 0.0, duration)]
+        print("📊 Short clip, transcribing in one pass")
+    elif chunking == "vad":
+        chunks = create_vad_chunks(audio_array, sample_rate, chunk_length)
+        speech = sum(end - start for _, start, end in chunks)
+        print(f"📊 Created {len(chunks)} VAD chunks covering {speech:.1f}s of {duration:.1f}s")
+    else:
+        chunks = create_audio_chunks(audio_array, sample_rate, chunk_length, stride)
+        print(f"📊 Created {len(chunks)} chunks (chunk_length={chunk_length}s, stride={stride}s)")
+    
+    # Process each chunk, merging segments as chunks finish
+    chunk_results = []
+    chunks_done = 0
+    merger = SegmentMerger()
+    detected_language = language
+    
+    def collect(results, end_time):
+        nonlocal chunks_done
+        new_segments = []
+        for segments, chunk_offset in results:
+            if keep_chunk_results:
+                chunk_results.append((segments, chunk_offset))
+            new_segments.extend(merger.add(segments, chunk_offset))
+        chunks_done += len(results)
+        if on_segments is not None:
+            on_segments(new_segments, chunks_done, len(chunks))
+        # Audio up to here is done; let a memory-mapped buffer drop its pages
+        release_pages(audio_array, 0, int(end_time * sample_rate))
+    
+    if batched or batcher is not None:
+        groups = group_chunks(chunks, batcher.group_size if batcher is not None else batch_size,
+                              first_size=FIRST_GROUP_CHUNKS)
+        for i, group in enumerate(groups, 1):
+            print(f"🔄 Processing batch {i}/{len(groups)} ({len(group)} chunks, "
+                  f"{group[0][1]:.1f}s - {group[-1][2]:.1f}s)...")
+            
+            if batcher is not None:
+                group_results, group_language = batcher.transcribe(
+                    model, audio_array, group, language=detected_language)
+            else:
+                group_results, group_language = transcribe_chunk_group(
+                    model, audio_array, sample_rate, group, batch_size, language=detected_language)
+            
+            if detected_language is None and group_language:
+                detected_language = group_language
+                print(f"🌐 Detected language: {detected_language}")
+            
+            collect(group_results, group[-1][2])
+            gc.collect()
+    else:
+        for i, (chunk_audio, start_time, end_time) in enumerate(chunks, 1):
+            print(f"🔄 Processing chunk {i}/{len(chunks)} ({start_time:.1f}s - {end_time:.1f}s)...")
+            
+            # Transcribe chunk
+            result = model.transcribe(chunk_audio, batch_size=batch_size, language=detected_language)
+            
+            # Detect language from first chunk if not specified
+            if detected_language is None and 'language' in result:
+                detected_language = result['language']
+                print(f"🌐 Detected language: {detected_language}")
+            
+            collect([(result['segments'], start_time)], end_time)
+            
+            # Clear some memory between chunks
+            if i % 5 == 0:
+                gc.collect()
+    
+    merged_segments = merger.segments()
+    print(f"🔗 Merged {chunks_done} chunks")
+    print(f"✅ Merged into {len(merged_segments)} segments")
+    
+    return {
+        'segments': merged_segments,
+        'chunk_results': chunk_results,
+        'language': detected_language or 'en'
+    }
@@ -1,11 +1,426 @@
 import grpc
 from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 import media_pb2 as pb2
 import media_pb2_grpc as pb2_grpc
 import tempfile
 import subprocess
+import threading
+import itertools
+import struct
+import shutil
+import json
+import time
+import uuid
 import os
 
+SAMPLE_RATE = 16000
+PCM_BLOCK_SIZE = 256 * 1024  # bytes read from ffmpeg's stdout at a time
+AUDIO_CHUNK_SIZE = 1024 * 1024  # bytes of PCM per StreamAudio message (last one may be shorter)
+
+# Directory shared with the STT service (same container, or a shared volume)
+ARTIFACT_DIR = os.environ.get("MEDIA_ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "media_artifacts"))
+ARTIFACT_TTL_SECONDS = float(os.environ.get("MEDIA_ARTIFACT_TTL", "3600"))  # unclaimed artifacts are removed after this
+
+# Parallel extraction: with MEDIA_EXTRACT_WORKERS > 1 uploads are written to a
+# file and long videos are split into time ranges decoded by separate ffmpeg
+# processes (at most MEDIA_EXTRACT_WORKERS across all requests)
+EXTRACT_WORKERS = int(os.environ.get("MEDIA_EXTRACT_WORKERS", "1"))
+EXTRACT_SEGMENT_SECONDS = float(os.environ.get("MEDIA_EXTRACT_SEGMENT", "300"))  # shortest range worth a process
+SEAM_MARGIN_SECONDS = 2  # each range is decoded this far past both of its ends
+SEAM_WINDOW = SAMPLE_RATE // 4  # samples that must match exactly to join two ranges
+SEAM_SEARCH = SAMPLE_RATE // 10  # samples either side of the expected seam to search
+SEAM_SHIFTS = (0, -0.25, 0.25, -0.5, 0.5, -1, 1, -1.5, 1.5)  # seam positions tried around a boundary (s)
+# Audio codecs whose decoders depend only on the bitstream, so a range decoded
+# after a seek settles on the same samples as one pass. Not AAC (noise
+# substitution) or AC-3 (dither): their random state depends on where decoding began.
+SPLITTABLE_CODECS = {"mp3", "mp2", "opus", "vorbis", "flac", "alac"}
+
+# Decode to raw 16 kHz mono PCM on stdout; the WAV header is added by us
+# Top-level ISO-BMFF boxes a MP4/QuickTime file can start with (classic .mov
+# files often start with wide or mdat and have no ftyp)
+TOP_LEVEL_BOXES = {b"ftyp", b"wide", b"free", b"skip", b"mdat", b"moov", b"pnot"}
+
+FFMPEG_OUTPUT = [
+    "-vn",                    # No video
+    "-acodec", "pcm_s16le",  # Audio codec
+    "-ar", str(SAMPLE_RATE),  # Sample rate
+    "-ac", "1",              # Mono
+    "-f", "s16le",
+    "pipe:1",
+]
+
+
+def needs_seeking(head):
+    """
+    Whether a container has to be written to a file before ffmpeg can read it.
+
+    Only MP4/MOV files whose moov atom comes after the media data need
+    seeking; faststart and fragmented MP4s and other containers decode from
+    a pipe. Returns None when `head` is too short to tell.
+    """
+    if len(head) < 12:
+        return None
+    if head[4:8] not in TOP_LEVEL_BOXES:
+        return False
+
+    offset = 0
+    while offset + 8 <= len(head):
+        size, box = struct.unpack(">I4s", head[offset:offset + 8])
+        if box in (b"moov", b"moof"):
+            return False
+        if box == b"mdat":
+            return True
+        if size == 1:  # 64-bit box size follows the type
+            if offset + 16 > len(head):
+                return None
+            size = struct.unpack(">Q", head[offset + 8:offset + 16])[0]
+        if size < 8:  # box runs to the end of the file, or is malformed
+            return True
+        offset += size
+    return None
+
+
+def wav_header(n_bytes):
+    """44-byte header for `n_bytes` of 16-bit mono PCM at SAMPLE_RATE."""
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + n_bytes, b"WAVE",
+                       b"fmt ", 16, 1, 1, SAMPLE_RATE, SAMPLE_RATE * 2, 2, 16,
+                       b"data", n_bytes)
+
+
+def ffmpeg_pcm(input_arg, feed=None, start=0, duration=None):
+    """
+    Run ffmpeg on `input_arg` and yield PCM blocks as it produces them.
+
+    With `feed` (an iterable of bytes) the input is written to ffmpeg's stdin
+    from a separate thread, so decoding overlaps with the upload. `start` and
+    `duration` (seconds) limit decoding to a time range of a seekable input.
+    Raises CalledProcessError when ffmpeg fails.
+    """
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    if start:
+        cmd += ["-ss", str(start)]
+    cmd += ["-i", input_arg]
+    if duration is not None:
+        cmd += ["-t", str(duration)]
+    cmd += FFMPEG_OUTPUT
+    stderr = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if feed is not None else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=stderr)
+
+    writer = None
+    feed_error = []
+    if feed is not None:
+        def write_input():
+            try:
+                for data in feed:
+                    proc.stdin.write(data)
+            except BrokenPipeError:
+                pass  # ffmpeg exited early; its stderr says why
+            except Exception as e:
+                feed_error.append(e)
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        writer = threading.Thread(target=write_input, daemon=True)
+        writer.start()
+
+    try:
+        while True:
+            block = proc.stdout.read(PCM_BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+        proc.wait()
+        if writer is not None:
+            writer.join()
+        if feed_error:
+            raise feed_error[0]
+        if proc.returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr.read())
+    finally:
+        # Also reached when the consumer stops early
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        stderr.close()
+
+
+def probe_audio(path):
+    """(duration in seconds, codec of the first audio stream) from ffprobe, or None if it cannot tell."""
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "a:0",
+           "-show_entries", "format=duration:stream=codec_name", "-of", "json", path]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        info = json.loads(result.stdout)
+        return float(info["format"]["duration"]), info["streams"][0]["codec_name"]
+    except (subprocess.CalledProcessError, ValueError, KeyError, IndexError, OSError):
+        return None
+
+
+def segment_ranges(duration, workers):
+    """
+    Split `duration` seconds into (start, end) ranges on whole seconds, one
+    per worker but none shorter than EXTRACT_SEGMENT_SECONDS; the last range
+    ends at None (end of input). Returns None when one range would do.
+    """
+    count = min(workers, int(duration // EXTRACT_SEGMENT_SECONDS))
+    if count < 2:
+        return None
+    bounds = [0] + [round(duration * k / count) for k in range(1, count)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def decode_range(path, start, end, directory, stop):
+    """
+    Decode [start, end) widened by SEAM_MARGIN_SECONDS on both sides, so
+    decoder and resampler have settled by the range's own ends, into a PCM
+    file in `directory`. Gives up early once `stop` is set.
+    Returns (pcm_path, decode_start).
+    """
+    decode_start = max(0, start - SEAM_MARGIN_SECONDS)
+    duration = end + SEAM_MARGIN_SECONDS - decode_start if end is not None else None
+    pcm_path = os.path.join(directory, f"{start}.pcm")
+    with open(pcm_path, "wb") as f:
+        for block in ffmpeg_pcm(path, start=decode_start, duration=duration):
+            if stop.is_set():
+                break
+            f.write(block)
+    return pcm_path, decode_start
+
+
+def read_at(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+def find_seam(previous, previous_start, current, current_start, boundary):
+    """
+    Byte offsets (p, q) where the PCM file `previous` can stop and `current`
+    carry on sample-exactly: SEAM_WINDOW samples of `previous` from p occur in
+    `current` at q, and nowhere else within SEAM_SEARCH samples of where the
+    decode start times put them (so stretches of digital silence or exact
+    repetition are never trusted). Seam positions are tried at SEAM_SHIFTS
+    around `boundary`. Returns None when no position gives a unique match.
+    """
+    for shift in SEAM_SHIFTS:
+        at = boundary + shift
+        p = round((at - previous_start) * SAMPLE_RATE) * 2
+        q = round((at - current_start) * SAMPLE_RATE) * 2
+        window = read_at(previous, p, SEAM_WINDOW * 2)
+        if len(window) < SEAM_WINDOW * 2:
+            continue
+
+        low = max(0, q - SEAM_SEARCH * 2)
+        region = read_at(current, low, q + (SEAM_SEARCH + SEAM_WINDOW) * 2 - low)
+        matches = []
+        found = region.find(window)
+        while found != -1 and len(matches) < 2:
+            if found % 2 == 0:  # whole samples only
+                matches.append(low + found)
+            found = region.find(window, found + 1)
+        if len(matches) == 1:
+            return p, matches[0]
+    return None
+
+
+def read_blocks(f, begin, end):
+    """Yield bytes [begin, end) of a file in PCM_BLOCK_SIZE blocks (end=None reads to the end)."""
+    f.seek(begin)
+    while end is None or begin < end:
+        block = f.read(PCM_BLOCK_SIZE if end is None else min(PCM_BLOCK_SIZE, end - begin))
+        if not block:
+            break
+        begin += len(block)
+        yield block
+
+
+def drop_prefix(blocks, n_bytes):
+    """Yield `blocks` without their first `n_bytes` bytes."""
+    for block in blocks:
+        if n_bytes >= len(block):
+            n_bytes -= len(block)
+            continue
+        yield block[n_bytes:]
+        n_bytes = 0
+
+
+EXTRACT_POOL = ThreadPoolExecutor(max_workers=max(EXTRACT_WORKERS, 1), thread_name_prefix="ffmpeg-range")
+
+
+def parallel_pcm(path, ranges):
+    """
+    Decode `ranges` of a video file concurrently and yield their PCM in order,
+    joined at seams verified by find_seam.
+
+    Ranges are decoded to temp files; range i is streamed out as soon as it
+    and range i + 1 are done and their seam is checked, and its file is then
+    removed. The result equals a single ffmpeg pass: if a seam cannot be
+    verified, the rest of the file comes from one pass, skipping what was
+    already sent.
+    """
+    directory = tempfile.mkdtemp(prefix="ranges_")
+    stop = threading.Event()
+    pending = [EXTRACT_POOL.submit(decode_range, path, start, end, directory, stop) for start, end in ranges]
+    emitted = 0
+    try:
+        previous_path, previous_start = pending[0].result()
+        previous = open(previous_path, "rb")
+        skip = 0
+        for (boundary, _), future in zip(ranges[1:], pending[1:]):
+            current_path, current_start = future.result()
+            current = open(current_path, "rb")
+            seam = find_seam(previous, previous_start, current, current_start, boundary)
+            if seam is None:
+                current.close()
+                break
+            for block in read_blocks(previous, skip, seam[0]):
+                emitted += len(block)
+                yield block
+            previous.close()
+            os.remove(previous_path)
+            previous, previous_path, previous_start, skip = current, current_path, current_start, seam[1]
+        else:
+            for block in read_blocks(previous, skip, None):
+                yield block
+            previous.close()
+            return
+
+        previous.close()
+        print(f"⚠️ Ranges do not line up at {boundary}s, decoding the rest in one pass")
+        stop.set()
+        yield from drop_prefix(ffmpeg_pcm(path), emitted)
+    finally:
+        # Also reached when the consumer stops early
+        stop.set()
+        for future in pending:
+            future.cancel()
+        for future in pending:
+            try:
+                future.result()
+            except Exception:
+                pass
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def file_pcm(path):
+    """
+    Yield PCM of a video file, in parallel ranges when it is long enough to
+    pay off and its audio codec is in SPLITTABLE_CODECS.
+    """
+    probe = probe_audio(path) if EXTRACT_WORKERS > 1 else None
+    ranges = None
+    if probe is not None and probe[1] in SPLITTABLE_CODECS:
+        duration = probe[0]
+        ranges = segment_ranges(duration, EXTRACT_WORKERS)
+    if ranges is None:
+        yield from ffmpeg_pcm(path)
+        return
+    print(f"⚡ Extracting {duration:.0f}s in {len(ranges)} parallel ranges")
+    yield from parallel_pcm(path, ranges)
+
+
+def extract_pcm(request_iterator):
+    """
+    Yield 16 kHz mono PCM from a stream of VideoChunk messages.
+
+    Chunks are piped into ffmpeg as they arrive, unless the container needs
+    seeking (see needs_seeking) or parallel extraction is on; only then is
+    the upload written to a temp file first.
+    """
+    chunks = (chunk.data for chunk in request_iterator)
+    head = []
+    seek = None
+    for data in chunks:
+        head.append(data)
+        seek = needs_seeking(b"".join(head))
+        if seek is not None:
+            break
+
+    if seek is False and EXTRACT_WORKERS <= 1:
+        print("🔀 Streaming upload into ffmpeg")
+        yield from ffmpeg_pcm("pipe:0", feed=itertools.chain(head, chunks))
+        return
+
+    # moov atom at the end, container unknown, or parallel ranges: ffmpeg needs a seekable file
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as vf:
+        total_bytes = 0
+        for data in itertools.chain(head, chunks):
+            vf.write(data)
+            total_bytes += len(data)
+        video_path = vf.name
+    print(f"✅ Complete video received: {total_bytes} bytes")
+
+    try:
+        yield from file_pcm(video_path)
+    finally:
+        try:
+            os.remove(video_path)
+        except Exception as e:
+            print(f"⚠️ Cleanup warning: {e}")
+
+
+def fixed_size_blocks(blocks, size):
+    """Re-cut a stream of byte blocks into blocks of exactly `size` bytes (the last may be shorter)."""
+    pending = bytearray()
+    for block in blocks:
+        pending += block
+        while len(pending) >= size:
+            yield bytes(pending[:size])
+            del pending[:size]
+    if pending:
+        yield bytes(pending)
+
+
+def expire_artifacts():
+    """Remove artifacts the STT service never picked up."""
+    cutoff = time.time() - ARTIFACT_TTL_SECONDS
+    for name in os.listdir(ARTIFACT_DIR):
+        path = os.path.join(ARTIFACT_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass  # claimed in the meantime
+
+
+def write_artifact(pcm_blocks):
+    """
+    Write PCM blocks as a WAV file in ARTIFACT_DIR; returns (artifact_id, size).
+
+    The file only appears under its final name once complete, so the STT
+    service never reads a partial artifact. No file is left without audio.
+    """
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    expire_artifacts()
+    artifact_id = uuid.uuid4().hex
+    partial_path = os.path.join(ARTIFACT_DIR, f"{artifact_id}.part")
+
+    total_bytes = 0
+    try:
+        with open(partial_path, "wb") as f:
+            f.write(wav_header(0))
+            for block in pcm_blocks:
+                f.write(block)
+                total_bytes += len(block)
+            f.seek(0)
+            f.write(wav_header(total_bytes))
+    except BaseException:
+        os.remove(partial_path)
+        raise
+
+    if not total_bytes:
+        os.remove(partial_path)
+        return "", 0
+    os.replace(partial_path, os.path.join(ARTIFACT_DIR, f"{artifact_id}.wav"))
+    return artifact_id, total_bytes + 44
+
+
 class MediaService(pb2_grpc.MediaServiceServicer):
 
     def HealthCheck(self, request, context):
@@ -16,59 +431,63 @@ class MediaService(pb2_grpc.MediaServiceServicer):
         request_iterator: Generator yielding VideoChunk messages
         Each chunk contains 4MB of video data
         """
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as vf:
-            total_bytes = 0
-            for chunk in request_iterator:
-                vf.write(chunk.data)
-                total_bytes += len(chunk.data)
-                print(f"Received chunk: {len(chunk.data)} bytes (Total: {total_bytes})")
-            video_path = vf.name
-
-        print(f"✅ Complete video received: {total_bytes} bytes")
-
-
-        audio_path = video_path.replace(".mp4", ".wav")
-
-        cmd = [
-            "ffmpeg", "-i", video_path,
-            "-vn",                    # No video
-            "-acodec", "pcm_s16le",  # Audio codec
-            "-ar", "16000",          # Sample rate
-            "-ac", "1",              # Mono
-            audio_path,
-            "-y"                     # Overwrite
-        ]
-
+        pcm = bytearray()
         try:
-            subprocess.run(cmd, check=True, capture_output=True)
-            print(f"✅ Audio extracted to: {audio_path}")
+            for block in extract_pcm(request_iterator):
+                pcm += block
         except subprocess.CalledProcessError as e:
             print(f"❌ FFmpeg error: {e.stderr.decode()}")
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details(f"FFmpeg failed: {e.stderr.decode()}")
             return pb2.AudioResponse()
 
-        with open(audio_path, "rb") as af:
-            audio_bytes = af.read()
+        print(f"✅ Audio size: {len(pcm)} bytes")
 
-        print(f"✅ Audio size: {len(audio_bytes)} bytes")
+        return pb2.AudioResponse(audio_data=wav_header(len(pcm)) + bytes(pcm))
 
+    def StreamAudio(self, request_iterator, context):
+        """
+        Yield the audio as AudioChunk messages of AUDIO_CHUNK_SIZE bytes while
+        ffmpeg decodes. The next chunk is produced only once gRPC has taken the
+        previous one, so a slow reader throttles ffmpeg instead of filling memory.
+        """
+        total_bytes = 0
+        try:
+            for data in fixed_size_blocks(extract_pcm(request_iterator), AUDIO_CHUNK_SIZE):
+                total_bytes += len(data)
+                yield pb2.AudioChunk(data=data, sample_rate=SAMPLE_RATE)
+        except subprocess.CalledProcessError as e:
+            print(f"❌ FFmpeg error: {e.stderr.decode()}")
+            context.abort(grpc.StatusCode.INTERNAL, f"FFmpeg failed: {e.stderr.decode()}")
+
+        print(f"✅ Audio streamed: {total_bytes} bytes")
 
+    def ExtractAudioArtifact(self, request_iterator, context):
+        """
+        Decode the upload straight into a WAV artifact for the STT service,
+        so the audio never travels back to the caller.
+        """
         try:
-            os.remove(video_path)
-            os.remove(audio_path)
-        except Exception as e:
-            print(f"⚠️ Cleanup warning: {e}")
+            artifact_id, size = write_artifact(extract_pcm(request_iterator))
+        except subprocess.CalledProcessError as e:
+            print(f"❌ FFmpeg error: {e.stderr.decode()}")
+            context.abort(grpc.StatusCode.INTERNAL, f"FFmpeg failed: {e.stderr.decode()}")
 
-        return pb2.AudioResponse(audio_data=audio_bytes)
+        print(f"✅ Audio artifact {artifact_id or '(empty)'}: {size} bytes")
+        return pb2.AudioArtifact(artifact_id=artifact_id, size_bytes=size)
 
 
 def serve():
     server = grpc.server(
         futures.ThreadPoolExecutor(max_workers=10),
         options=[
+            # Unlimited send is only for the single-message ExtractAudio response;
+            # StreamAudio chunks fit the default limits
             ("grpc.max_send_message_length", -1),    # Unlimited send
             ("grpc.max_receive_message_length", -1), # Unlimited receive
+            # Accept the gateway's keepalive pings on idle pooled channels
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.min_recv_ping_interval_without_data_ms", 30000),
         ]
     )
     pb2_grpc.add_MediaServiceServicer_to_server(MediaService(), server)
@@ -79,4 +498,4 @@ def serve():
 
 
 if __name__ == "__main__":
-    serve()
\ No newline at end of file
+    serve()
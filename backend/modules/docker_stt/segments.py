@@ -0,0 +1,465 @@
+import bisect
+import math
+
+# A segment is a duplicate when more than this fraction of it overlaps a kept one
+DUPLICATE_OVERLAP = 0.8
+# Max start-time difference (seconds) for two equal words to count as one
+WORD_DEDUP_TOLERANCE = 0.2
+
+
+def shift_segment(seg, offset):
+    """Return a copy of `seg` with segment and word times moved by `offset`."""
+    adjusted_seg = seg.copy()
+    adjusted_seg['start'] += offset
+    adjusted_seg['end'] += offset
+
+    if 'words' in adjusted_seg:
+        adjusted_words = []
+        for word in adjusted_seg['words']:
+            adjusted_word = word.copy()
+            if 'start' in adjusted_word and adjusted_word['start'] is not None:
+                adjusted_word['start'] += offset
+            if 'end' in adjusted_word and adjusted_word['end'] is not None:
+                adjusted_word['end'] += offset
+            adjusted_words.append(adjusted_word)
+        adjusted_seg['words'] = adjusted_words
+
+    return adjusted_seg
+
+
+def _normalize_word(text):
+    return text.strip().strip('.,!?;:"\'').lower()
+
+
+class SegmentMerger:
+    """
+    Sweep-line merge of segments coming from overlapping chunks.
+
+    Kept segments are stored sorted by start time. A new segment can only
+    overlap kept segments starting in [start - longest_kept, end), which is
+    found with bisect, so each lookup is O(log n) plus the few neighbours in
+    that window. Chunks arrive in time order, so insertions land at the tail.
+
+    Raw transcription segments carry no words, so partial duplicates that
+    pass the overlap rule are left for dedup_words after alignment.
+    """
+
+    def __init__(self, overlap_threshold=DUPLICATE_OVERLAP):
+        self.overlap_threshold = overlap_threshold
+        self._starts = []
+        self._kept = []
+        self._max_duration = 0.0
+
+    def add(self, segments, chunk_offset):
+        """
+        Merge the segments of one chunk.
+
+        Args:
+            segments: segments with times relative to the chunk
+            chunk_offset: chunk start time on the global timeline
+
+        Returns:
+            List of segments that were kept (global times)
+        """
+        accepted = []
+        for seg in segments:
+            seg = shift_segment(seg, chunk_offset)
+            if self._is_duplicate(seg, self._overlapping(seg)):
+                continue
+
+            idx = bisect.bisect_right(self._starts, seg['start'])
+            self._starts.insert(idx, seg['start'])
+            self._kept.insert(idx, seg)
+            self._max_duration = max(self._max_duration, seg['end'] - seg['start'])
+            accepted.append(seg)
+
+        return accepted
+
+    def segments(self):
+        """All kept segments sorted by start time."""
+        return list(self._kept)
+
+    def _overlapping(self, seg):
+        lo = bisect.bisect_left(self._starts, seg['start'] - self._max_duration)
+        hi = bisect.bisect_left(self._starts, seg['end'])
+        return [existing for existing in self._kept[lo:hi] if existing['end'] > seg['start']]
+
+    def _is_duplicate(self, seg, neighbours):
+        seg_duration = seg['end'] - seg['start']
+        for existing in neighbours:
+            overlap_start = max(seg['start'], existing['start'])
+            overlap_end = min(seg['end'], existing['end'])
+            overlap_duration = max(0, overlap_end - overlap_start)
+
+            # If more than 80% of segment overlaps, consider it duplicate
+            if overlap_duration > self.overlap_threshold * seg_duration:
+                return True
+        return False
+
+
+def _drop_repeated_words(seg, neighbours, tolerance):
+    """Copy of `seg` without the words an overlapping kept segment already has, or None if none are left."""
+    seen = {}
+    for existing in neighbours:
+        for word in existing.get('words', []):
+            if word.get('start') is not None:
+                seen.setdefault(_normalize_word(word['word']), []).append(word['start'])
+
+    words = []
+    for word in seg['words']:
+        starts = seen.get(_normalize_word(word['word']), ())
+        if word.get('start') is not None and any(abs(word['start'] - s) <= tolerance for s in starts):
+            continue
+        words.append(word)
+
+    if len(words) == len(seg['words']):
+        return seg
+    if not words:
+        return None
+
+    seg = dict(seg, words=words)
+    timed = [w for w in words if w.get('start') is not None and w.get('end') is not None]
+    if timed:
+        seg['start'] = timed[0]['start']
+        seg['end'] = timed[-1]['end']
+    seg['text'] = " " + " ".join(w['word'].strip() for w in words)
+    return seg
+
+
+def dedup_words(segments, tolerance=WORD_DEDUP_TOLERANCE):
+    """
+    Drop words repeated across overlapping segments, matched by text and start time.
+
+    Overlapping chunks transcribe the audio they share twice. A copy that
+    covers most of a kept segment is dropped by SegmentMerger, but partial
+    copies survive it. Once aligned, the repeated words of such segments
+    land on the same audio, so each segment loses the words an earlier
+    overlapping segment already has. Segments without words pass through.
+
+    Args:
+        segments: aligned segments sorted by start time
+        tolerance: max start-time difference (seconds) for two equal words
+
+    Returns:
+        List of segments; segments left without words are dropped
+    """
+    kept = []
+    starts = []  # original starts, so trimmed segments keep the list sorted
+    max_duration = 0.0
+    for seg in segments:
+        original_start = seg['start']
+        if seg.get('words'):
+            lo = bisect.bisect_left(starts, seg['start'] - max_duration - tolerance)
+            neighbours = [existing for existing in kept[lo:] if existing['end'] + tolerance > seg['start']]
+            if neighbours:
+                seg = _drop_repeated_words(seg, neighbours, tolerance)
+                if seg is None:
+                    continue
+        kept.append(seg)
+        starts.append(original_start)
+        max_duration = max(max_duration, seg['end'] - original_start)
+    return kept
+
+
+def merge_segments_from_chunks(chunk_results):
+    """
+    Merge segments from overlapping chunks, removing duplicates.
+
+    Args:
+        chunk_results: List of (segments, chunk_start_time) tuples
+
+    Returns:
+        Merged list of segments
+    """
+    merger = SegmentMerger()
+    for segments, chunk_offset in chunk_results:
+        merger.add(segments, chunk_offset)
+    return merger.segments()
+
+
+class SpeakerTimeline:
+    """
+    Diarization turns indexed for overlap queries.
+
+    Turns are sorted by start and paired with a running maximum of their end
+    times, so the first turn that can overlap a word is found with bisect even
+    when turns overlap each other.
+    """
+
+    def __init__(self, diar_segments):
+        self._turns = sorted(diar_segments, key=lambda t: t["start_time"])
+        self._starts = [t["start_time"] for t in self._turns]
+        self._max_ends = []
+        max_end = float("-inf")
+        for turn in self._turns:
+            max_end = max(max_end, turn["end_time"])
+            self._max_ends.append(max_end)
+
+    def speaker_for(self, start, end):
+        """Speaker with the largest overlap with [start, end], or "Unknown"."""
+        if end <= start:
+            end = start + 1e-3
+
+        speaker = "Unknown"
+        best_overlap = 0.0
+        i = bisect.bisect_right(self._max_ends, start)
+        while i < len(self._turns) and self._starts[i] < end:
+            turn = self._turns[i]
+            overlap = min(end, turn["end_time"]) - max(start, turn["start_time"])
+            if overlap > best_overlap:
+                best_overlap = overlap
+                speaker = turn["speaker"]
+            i += 1
+        return speaker
+
+
+def _assign_words(words, timeline):
+    result = []
+    for word in words:
+        w_start, w_end = word.get("start"), word.get("end")
+        if w_start is None or w_end is None:
+            continue
+
+        result.append({
+            "word": word["word"],
+            "start": w_start,
+            "end": w_end,
+            "score": word.get("score"),
+            "speaker": timeline.speaker_for(w_start, w_end)
+        })
+    return result
+
+
+def _majority_speaker(words):
+    speaker_counts = {}
+    for word in words:
+        speaker = word.get("speaker", "Unknown")
+        speaker_counts[speaker] = speaker_counts.get(speaker, 0) + 1
+
+    return max(speaker_counts, key=speaker_counts.get) if speaker_counts else "Unknown"
+
+
+def assign_word_speakers(words, diar_segments):
+    """Assign each word the speaker it overlaps most."""
+    return _assign_words(words, SpeakerTimeline(diar_segments))
+
+
+def assign_speakers(segments, diar_segments):
+    """
+    Assign speakers to every word and segment in one pass.
+
+    Words get the speaker they overlap most; each segment gets the majority
+    speaker of its words (or of its own time span when it has no words),
+    stored under "speaker".
+    """
+    timeline = SpeakerTimeline(diar_segments)
+    for seg in segments:
+        if seg.get("words"):
+            seg["words"] = _assign_words(seg["words"], timeline)
+            seg["speaker"] = _majority_speaker(seg["words"])
+        else:
+            seg["speaker"] = timeline.speaker_for(seg["start"], seg["end"])
+    return segments
+
+
+def get_segment_speaker(segment):
+    """Determine primary speaker from word-level assignments."""
+    if "speaker" in segment:
+        return segment["speaker"]
+    if "words" not in segment or not segment["words"]:
+        return "Unknown"
+
+    return _majority_speaker(segment["words"])
+
+
+def format_time(seconds, separator=","):
+    """Convert seconds to SRT time format (WebVTT uses "." as separator)."""
+    h = int(seconds // 3600)
+    m = int((seconds % 3600) // 60)
+    s = int(seconds % 60)
+    ms = int((seconds % 1) * 1000)
+    return f"{h:02}:{m:02}:{s:02}{separator}{ms:03}"
+
+
+def render_srt(segments):
+    """Segments as an SRT document."""
+    lines = []
+    for i, seg in enumerate(segments, 1):
+        start = format_time(seg["start"])
+        end = format_time(seg["end"])
+        lines.append(f"{i}\n{start} --> {end}\n[{get_segment_speaker(seg)}] {seg['text'].strip()}\n\n")
+    return "".join(lines)
+
+
+def render_vtt(segments):
+    """Segments as a WebVTT document, speakers as voice tags."""
+    lines = ["WEBVTT\n\n"]
+    for seg in segments:
+        start = format_time(seg["start"], ".")
+        end = format_time(seg["end"], ".")
+        lines.append(f"{start} --> {end}\n<v {get_segment_speaker(seg)}>{seg['text'].strip()}\n\n")
+    return "".join(lines)
+
+
+def render_text(segments):
+    """Plain transcript, one line per speaker turn."""
+    lines = []
+    for seg in segments:
+        speaker = get_segment_speaker(seg)
+        text = seg["text"].strip()
+        if lines and lines[-1][0] == speaker:
+            lines[-1][1].append(text)
+        else:
+            lines.append((speaker, [text]))
+    return "\n".join(f"[{speaker}] {' '.join(texts)}" for speaker, texts in lines)
+
+
+def _round(value, digits=3):
+    return round(float(value), digits) if value is not None else None
+
+
+def render_compact(segments):
+    """
+    Columnar segments and words.
+
+    Each field is one array, so keys are not repeated per word. Words point
+    to their segment through the "segment" index array.
+    """
+    seg_columns = {"start": [], "end": [], "speaker": [], "text": []}
+    word_columns = {"word": [], "start": [], "end": [], "score": [], "speaker": [], "segment": []}
+
+    for i, seg in enumerate(segments):
+        seg_columns["start"].append(_round(seg["start"]))
+        seg_columns["end"].append(_round(seg["end"]))
+        seg_columns["speaker"].append(get_segment_speaker(seg))
+        seg_columns["text"].append(seg["text"].strip())
+
+        for word in seg.get("words", []):
+            word_columns["word"].append(word["word"])
+            word_columns["start"].append(_round(word.get("start")))
+            word_columns["end"].append(_round(word.get("end")))
+            word_columns["score"].append(_round(word.get("score")))
+            word_columns["speaker"].append(word.get("speaker", "Unknown"))
+            word_columns["segment"].append(i)
+
+    return {"segments": seg_columns, "words": word_columns}
+
+
+def _similarity(a, b):
+    """Cosine similarity of two profile vectors."""
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a) * sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def _turn_overlap(a, b, lo, hi):
+    start = max(a["start_time"], b["start_time"], lo)
+    end = min(a["end_time"], b["end_time"], hi)
+    return max(0.0, end - start)
+
+
+class SpeakerStitcher:
+    """
+    Joins diarization turns from overlapping windows into one timeline.
+
+    Each window labels speakers on its own, so labels of a new window are
+    mapped to the global labels they overlap most with in the region shared
+    with the previous window (greedy, largest overlap first). Speakers who
+    are silent in that region are matched by voice profile instead: every
+    global label keeps the mean profile of the local speakers mapped to it,
+    and an unmatched speaker takes the most similar unused label if the
+    cosine similarity reaches `min_similarity`. Only speakers matching
+    neither way get new global labels. The two windows are cut at the middle
+    of their shared region.
+    """
+
+    def __init__(self, min_similarity=0.95):
+        self.turns = []
+        self.min_similarity = min_similarity
+        self._prev_turns = []
+        self._prev_end = None
+        self._n_speakers = 0
+        self._profiles = {}  # global label -> (profile sum, count)
+
+    def add(self, window_turns, window_start, window_end, profiles=None):
+        """
+        Add the turns of one window (times already on the global timeline).
+
+        `profiles` maps local labels to voice profile vectors (any fixed-length
+        embedding); speakers without one can only be matched by overlap.
+        Windows must be added in time order.
+        """
+        profiles = profiles or {}
+        overlap_start, overlap_end = window_start, self._prev_end or window_start
+        mapping = self._match_labels(window_turns, overlap_start, overlap_end, profiles)
+        for local, profile in profiles.items():
+            if local in mapping:
+                self._add_profile(mapping[local], profile)
+
+        cut = (overlap_start + overlap_end) / 2 if overlap_end > overlap_start else window_start
+        kept = []
+        for turn in self.turns:
+            if turn["start_time"] >= cut:
+                continue
+            kept.append(dict(turn, end_time=min(turn["end_time"], cut)))
+        self.turns = kept
+
+        mapped = []
+        for turn in window_turns:
+            mapped_turn = dict(turn, speaker=mapping[turn["speaker"]])
+            mapped.append(mapped_turn)
+            if turn["end_time"] > cut:
+                self.turns.append(dict(mapped_turn, start_time=max(turn["start_time"], cut)))
+
+        self._prev_turns = mapped
+        self._prev_end = window_end
+
+    def result(self):
+        """Stitched turns sorted by start time."""
+        return sorted(self.turns, key=lambda t: t["start_time"])
+
+    def speakers(self):
+        """Global labels handed out so far."""
+        return [f"speaker_{i}" for i in range(self._n_speakers)]
+
+    def _add_profile(self, label, profile):
+        total, count = self._profiles.get(label, (None, 0))
+        total = list(profile) if total is None else [t + p for t, p in zip(total, profile)]
+        self._profiles[label] = (total, count + 1)
+
+    def _match_labels(self, window_turns, lo, hi, profiles):
+        overlaps = {}
+        if hi > lo:
+            for new in window_turns:
+                for prev in self._prev_turns:
+                    seconds = _turn_overlap(new, prev, lo, hi)
+                    if seconds > 0:
+                        key = (new["speaker"], prev["speaker"])
+                        overlaps[key] = overlaps.get(key, 0.0) + seconds
+
+        mapping = {}
+        used = set()
+        for (local, global_label), _ in sorted(overlaps.items(), key=lambda item: -item[1]):
+            if local not in mapping and global_label not in used:
+                mapping[local] = global_label
+                used.add(global_label)
+
+        similarities = []
+        for local, profile in profiles.items():
+            if local in mapping:
+                continue
+            for global_label, (total, count) in self._profiles.items():
+                if global_label not in used:
+                    similarities.append((_similarity(profile, total), local, global_label))
+        for similarity, local, global_label in sorted(similarities, key=lambda item: -item[0]):
+            if similarity < self.min_similarity:
+                break
+            if local not in mapping and global_label not in used:
+                mapping[local] = global_label
+                used.add(global_label)
+
+        for turn in sorted(window_turns, key=lambda t: t["start_time"]):
+            if turn["speaker"] not in mapping:
+                mapping[turn["speaker"]] = f"speaker_{self._n_speakers}"
+                self._n_speakers += 1
+        return mapping
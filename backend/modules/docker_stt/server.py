@@ -2,6 +2,8 @@ import os
 os.environ['TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD'] = '1'
 
 from fastapi import FastAPI, UploadFile, File, Form
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 import uvicorn
 import torch
 import shutil
@@ -9,14 +11,34 @@ import sys
 import warnings
 import gc
 import json
+import re
 import time
 import subprocess
 import tempfile
+import threading
+import asyncio
+import uuid
+import struct
+import hashlib
+import resource
+import mmap
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import whisperx
 from nemo.collections.asr.models import SortformerEncLabelModel
 import numpy as np
 
+from chunking import (
+    SAMPLE_RATE, CHUNK_LENGTH, STRIDE, CHUNKING_MODE, VAD_FRAME, BATCH_FILES, release_pages,
+    frame_energy_db, detect_speech_regions, ChunkBatcher, transcribe_with_chunking,
+)
+from segments import (
+    shift_segment, dedup_words, assign_speakers, SpeakerStitcher,
+    render_srt, render_vtt, render_text, render_compact,
+)
+
 warnings.filterwarnings('ignore', category=UserWarning)
 
 # Setup cuDNN paths
@@ -42,250 +64,692 @@ except Exception as e:
 
 app = FastAPI()
 
-# Chunking configuration
-CHUNK_LENGTH = 30.0  # 30 seconds per chunk (Whisper's optimal size)
-STRIDE = CHUNK_LENGTH / 6  # 5 seconds overlap to prevent word splitting
+# Audio decoding configuration
+MMAP_MIN_SECONDS = float(os.environ.get("STT_MMAP_MIN_SECONDS", "600"))  # memory-map longer inputs
 
+# Alignment runs over windows of this many seconds (plus margin) of audio
+ALIGN_WINDOW_SECONDS = float(os.environ.get("STT_ALIGN_WINDOW", "300"))
+ALIGN_MARGIN = 1.0
 
-def convert_to_mono_16k(input_file):
-    """Convert audio to mono 16kHz WAV using FFmpeg (memory efficient)."""
-    output_file = os.path.splitext(input_file)[0] + "_mono16k.wav"
-    cmd = [
-        'ffmpeg', '-i', input_file,
-        '-ac', '1',  # mono
-        '-ar', '16000',  # 16kHz
-        '-y',  # overwrite
-        output_file
-    ]
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-    return output_file
+# Windowed diarization: audio longer than one window is diarized in overlapping
+# windows, DIAR_BATCH_SIZE windows per Sortformer call
+DIAR_WINDOW_SECONDS = float(os.environ.get("STT_DIAR_WINDOW", "300"))
+DIAR_OVERLAP_SECONDS = float(os.environ.get("STT_DIAR_OVERLAP", "20"))
+DIAR_BATCH_SIZE = int(os.environ.get("STT_DIAR_BATCH", "4"))
 
+# Adaptive fast paths: clips up to SINGLE_SPEAKER_MAX_SECONDS are checked for a
+# second speaker before Sortformer runs (STT_SPEAKER_SEPARATION=0 always diarizes)
+SINGLE_SPEAKER_MAX_SECONDS = float(os.environ.get("STT_SINGLE_SPEAKER_MAX", "600"))
+SPEAKER_SEPARATION = float(os.environ.get("STT_SPEAKER_SEPARATION", "1.5"))  # cluster distance / spread
+SPEAKER_WINDOW = 1.5  # seconds of speech per spectral profile
+SPEAKER_BANDS = 24  # log-spaced bands between 100 Hz and 4 kHz
+DIARIZE_MODES = ("auto", "on", "off")
+# Diarization windows are stitched by these spectral profiles when a speaker is
+# silent in the overlap with the previous window (see SpeakerStitcher)
+SPEAKER_MATCH_SIMILARITY = float(os.environ.get("STT_SPEAKER_MATCH", "0.95"))  # min cosine similarity
+SPEAKER_PROFILE_SECONDS = 60.0  # longest turns up to this much audio per speaker and window
 
-def get_audio_duration(audio_file):
-    """Get audio duration using FFprobe."""
-    cmd = [
-        'ffprobe', '-v', 'error',
-        '-show_entries', 'format=duration',
-        '-of', 'default=noprint_wrappers=1:nokey=1',
-        audio_file
-    ]
-    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-    return float(result.stdout.strip())
+# Job queue configuration
+STT_WORKERS = int(os.environ.get("STT_WORKERS", "1"))  # pipelines running at once
+JOB_TTL_SECONDS = float(os.environ.get("STT_JOB_TTL", "3600"))  # keep finished jobs this long
+SSE_POLL_INTERVAL = 0.5  # seconds between checks for new job events
+SSE_KEEPALIVE_INTERVAL = 15.0  # idle seconds before a keep-alive comment is sent
+
+# Audio handed over by the media service (grpc_server.py) as MEDIA_ARTIFACT_DIR/<id>.wav
+ARTIFACT_DIR = os.environ.get("MEDIA_ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "media_artifacts"))
+ARTIFACT_ID = re.compile(r"[0-9a-f]{32}")
 
+# Admission control: jobs start only while their estimated working memory fits
+# in STT_ADMISSION_MB, so STT_WORKERS can be raised without risking OOM on long inputs
+ADMISSION_BUDGET_MB = float(os.environ.get("STT_ADMISSION_MB", "4096"))
+ADMISSION_BASE_MB = 300.0  # per-job overhead independent of input length
+ADMISSION_AUDIO_COPIES = 3  # decoded float32 audio plus chunk batches and alignment windows
+ADMISSION_FALLBACK_BYTES_PER_SECOND = 16000  # ~128 kbps when ffprobe cannot read the input
 
-def create_audio_chunks(audio_array, sample_rate, chunk_length, stride):
+# Output formats: name -> (response key, renderer)
+OUTPUT_FORMATS = {
+    "srt": ("srt_content", render_srt),
+    "vtt": ("vtt_content", render_vtt),
+    "text": ("text_content", render_text),
+    "compact": ("compact_content", render_compact),
+    "json": ("json_content", lambda segments: {"segments": segments}),
+}
+DEFAULT_FORMATS = "srt"
+
+# Stage cache configuration (STT_CACHE_MB=0 disables it)
+STAGE_CACHE_DIR = os.environ.get("STT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "stt_stage_cache"))
+STAGE_CACHE_MAX_MB = float(os.environ.get("STT_CACHE_MB", "2048"))
+
+# Model pool configuration
+WHISPER_MODEL_SIZE = os.environ.get("STT_WHISPER_MODEL", "small")
+SORTFORMER_MODEL = "nvidia/diar_streaming_sortformer_4spk-v2"
+MODEL_POOL_BUDGET_MB = float(os.environ.get("STT_MODEL_POOL_MB", "6144"))
+
+# Fallback resident sizes (MB) when the device cannot report allocations (CPU)
+# or when loads overlapped
+MODEL_SIZE_ESTIMATES_MB = {
+    "whisper": 1000,
+    "align": 400,
+    "sortformer": 600,
+}
+
+
+def device_memory_mb():
+    """Currently allocated CUDA memory in MB (0 on CPU)."""
+    if torch.cuda.is_available():
+        return torch.cuda.memory_allocated() / (1024 ** 2)
+    return 0.0
+
+
+class ModelPool:
     """
-    Split audio into overlapping chunks.
+    Keeps loaded models resident between requests.
     
-    Args:
-        audio_array: numpy array of audio samples
-        sample_rate: audio sample rate (16000)
-        chunk_length: length of each chunk in seconds (30.0)
-        stride: overlap between chunks in seconds (5.0)
-    
-    Returns:
-        List of (chunk_audio, start_time, end_time) tuples
+    Models are keyed by tuples whose first element is the model kind
+    ("whisper", "align", "sortformer"). When the summed size of resident
+    models exceeds the memory budget, the least recently used ones are dropped.
     """
-    chunk_samples = int(chunk_length * sample_rate)
-    stride_samples = int(stride * sample_rate)
     
-    chunks = []
-    total_samples = len(audio_array)
+    def __init__(self, budget_mb):
+        self.budget_mb = budget_mb
+        self.load_counts = {}
+        self._models = OrderedDict()  # key -> (model, size_mb)
+        self._lock = threading.Lock()  # guards the dicts only, never held while loading
+        self._key_locks = {}  # key -> lock held while that model loads
+        self._loads_started = 0
+        self._loads_running = 0
     
-    start_sample = 0
-    while start_sample < total_samples:
-        end_sample = min(start_sample + chunk_samples, total_samples)
-        
-        chunk_audio = audio_array[start_sample:end_sample]
-        start_time = start_sample / sample_rate
-        end_time = end_sample / sample_rate
+    def get(self, key, loader, *args, **kwargs):
+        """
+        Return the model for `key`, calling `loader` only on a miss.
         
-        chunks.append((chunk_audio, start_time, end_time))
+        Loads run outside the pool lock, so lookups of resident models and
+        loads of other models are never blocked by a slow load; threads
+        asking for the same model wait for a single load.
+        """
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
         
-        # Move to next chunk with stride overlap
-        start_sample += chunk_samples - stride_samples
-        
-        # If we've reached the end, break
-        if end_sample >= total_samples:
-            break
+        with key_lock:
+            with self._lock:
+                if key in self._models:  # loaded while we waited
+                    self._models.move_to_end(key)
+                    return self._models[key][0]
+                overlapped = self._loads_running > 0
+                self._loads_started += 1
+                self._loads_running += 1
+                started = self._loads_started
+            
+            print(f"📦 Loading model {key}...")
+            before = device_memory_mb()
+            try:
+                model = loader(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._loads_running -= 1
+                    overlapped = overlapped or self._loads_started != started
+            size_mb = device_memory_mb() - before
+            # Concurrent loads make the memory delta meaningless
+            if size_mb <= 0 or overlapped:
+                size_mb = MODEL_SIZE_ESTIMATES_MB.get(key[0], 500)
+            
+            with self._lock:
+                self._models[key] = (model, size_mb)
+                self.load_counts[key[0]] = self.load_counts.get(key[0], 0) + 1
+                self._evict(keep=key)
+            return model
+    
+    def resident_mb(self):
+        return sum(size for _, size in self._models.values())
     
-    return chunks
+    def clear(self):
+        """Drop every resident model."""
+        with self._lock:
+            self._models.clear()
+        gc.collect()
+    
+    def _evict(self, keep):
+        evicted = False
+        while self.resident_mb() > self.budget_mb and len(self._models) > 1:
+            key = next(iter(self._models))
+            if key == keep:
+                self._models.move_to_end(key)
+                continue
+            _, size_mb = self._models.pop(key)
+            print(f"♻️ Evicted model {key} ({size_mb:.0f} MB)")
+            evicted = True
+        if evicted:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
 
 
-def merge_segments_from_chunks(chunk_results):
+class ExclusiveModel:
     """
-    Merge segments from overlapping chunks, removing duplicates.
-    
-    Args:
-        chunk_results: List of (segments, chunk_start_time) tuples
+    A pooled model that runs one `transcribe` or `diarize` call at a time.
     
-    Returns:
-        Merged list of segments
+    Every pipeline (job workers and the files of each batch) shares the
+    resident instance, but neither call is reentrant: WhisperX swaps
+    `self.tokenizer` in and out around a transcribe with language=None, and
+    NeMo's diarize reconfigures the preprocessor and keeps per-call maps on
+    the model. Calls take turns per instance; other attributes pass through.
     """
-    all_segments = []
     
-    for segments, chunk_offset in chunk_results:
-        for seg in segments:
-            # Adjust segment times to global timeline
-            adjusted_seg = seg.copy()
-            adjusted_seg['start'] += chunk_offset
-            adjusted_seg['end'] += chunk_offset
-            
-            # Adjust word timings if present
-            if 'words' in adjusted_seg:
-                adjusted_words = []
-                for word in adjusted_seg['words']:
-                    adjusted_word = word.copy()
-                    if 'start' in adjusted_word and adjusted_word['start'] is not None:
-                        adjusted_word['start'] += chunk_offset
-                    if 'end' in adjusted_word and adjusted_word['end'] is not None:
-                        adjusted_word['end'] += chunk_offset
-                    adjusted_words.append(adjusted_word)
-                adjusted_seg['words'] = adjusted_words
-            
-            all_segments.append(adjusted_seg)
-    
-    # Remove overlapping duplicates (keep segments from later chunks in overlap regions)
-    merged_segments = []
-    for seg in all_segments:
-        # Check if this segment overlaps significantly with any existing segment
-        is_duplicate = False
-        for existing in merged_segments:
-            overlap_start = max(seg['start'], existing['start'])
-            overlap_end = min(seg['end'], existing['end'])
-            overlap_duration = max(0, overlap_end - overlap_start)
-            
-            seg_duration = seg['end'] - seg['start']
-            
-            # If more than 80% of segment overlaps, consider it duplicate
-            if overlap_duration > 0.8 * seg_duration:
-                is_duplicate = True
-                break
-        
-        if not is_duplicate:
-            merged_segments.append(seg)
+    def __init__(self, model):
+        self.model = model
+        self._lock = threading.Lock()
+    
+    def transcribe(self, *args, **kwargs):
+        with self._lock:
+            return self.model.transcribe(*args, **kwargs)
     
-    # Sort by start time
-    merged_segments.sort(key=lambda x: x['start'])
+    def diarize(self, *args, **kwargs):
+        with self._lock:
+            return self.model.diarize(*args, **kwargs)
     
-    return merged_segments
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+MODEL_POOL = ModelPool(MODEL_POOL_BUDGET_MB)
+
+# Diarization runs beside ASR; one thread per concurrent pipeline (job workers
+# plus the files of a batch, see JobManager)
+DIARIZATION_EXECUTOR = ThreadPoolExecutor(max_workers=STT_WORKERS + BATCH_FILES, thread_name_prefix="stt-diarize")
 
 
-def transcribe_with_chunking(audio_file, model, device, chunk_length=30.0, stride=5.0, language=None):
+class StageCache:
     """
-    Transcribe audio file using chunking strategy.
+    Content-addressed on-disk cache of pipeline stage outputs.
     
-    Args:
-        audio_file: path to audio file
-        model: WhisperX model
-        device: cuda or cpu
-        chunk_length: length of each chunk in seconds
-        stride: overlap between chunks in seconds
-        language: language code or None for auto-detect
-    
-    Returns:
-        dict with 'segments' and 'language'
+    Each entry is a JSON file named after the hash of the input audio, the
+    stage name and the stage parameters, so a request reuses every stage
+    whose inputs match. Reads refresh the file's mtime and the least recently
+    used entries are deleted once the directory exceeds `max_mb`.
     """
-    print(f"📊 Loading audio for chunked processing...")
     
-    # Load full audio
-    audio_array = whisperx.load_audio(audio_file)
-    sample_rate = 16000
-    duration = len(audio_array) / sample_rate
+    def __init__(self, root, max_mb):
+        self.root = root
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(root, exist_ok=True)
     
-    print(f"📊 Audio duration: {duration:.2f}s")
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
     
-    # Create chunks
-    chunks = create_audio_chunks(audio_array, sample_rate, chunk_length, stride)
-    print(f"📊 Created {len(chunks)} chunks (chunk_length={chunk_length}s, stride={stride}s)")
+    def key(self, audio_hash, stage, params):
+        """Cache key for `stage` run on `audio_hash` with `params`."""
+        blob = json.dumps([audio_hash, stage, params], sort_keys=True, default=str)
+        return f"{stage}_{hashlib.sha256(blob.encode('utf-8')).hexdigest()}"
     
-    # Process each chunk
-    chunk_results = []
-    detected_language = language
+    def get(self, key):
+        """Cached value for `key`, or None on a miss."""
+        if not self.enabled:
+            return None
+        path = os.path.join(self.root, key + ".json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path)
+            return value
+        except (OSError, ValueError):
+            return None
     
-    for i, (chunk_audio, start_time, end_time) in enumerate(chunks, 1):
-        print(f"🔄 Processing chunk {i}/{len(chunks)} ({start_time:.1f}s - {end_time:.1f}s)...")
-        
-        # Transcribe chunk
-        result = model.transcribe(chunk_audio, batch_size=16, language=detected_language)
+    def put(self, key, value):
+        """Store `value` (JSON-serialisable) under `key` and enforce the size cap."""
+        if not self.enabled:
+            return
+        path = os.path.join(self.root, key + ".json")
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False, default=float)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠ Stage cache write failed: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+    
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.root):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+STAGE_CACHE = StageCache(STAGE_CACHE_DIR, STAGE_CACHE_MAX_MB)
+
+
+# Histogram buckets for per-stage latency (seconds) and real-time factor
+STAGE_BUCKETS = (0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+RTF_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 1, 2)
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """Cumulative Prometheus histogram, optionally split by one label."""
+    
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label = label
+        self._series = {}  # label value -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+    
+    def observe(self, value, label_value=None):
+        with self._lock:
+            series = self._series.setdefault(label_value, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, series in sorted(self._series.items(), key=lambda item: str(item[0])):
+                base = f'{self.label}="{_label_value(label_value)}",' if self.label else ""
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{{base}le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{base}le="+Inf"}} {series[-1]}')
+                suffix = f"{{{base.rstrip(',')}}}" if base else ""
+                lines.append(f"{self.name}_sum{suffix} {series[-2]}")
+                lines.append(f"{self.name}_count{suffix} {series[-1]}")
+        return lines
+
+
+class Metrics:
+    """Per-stage latency, real-time factor and job counters for /metrics."""
+    
+    def __init__(self):
+        self.stage_seconds = Histogram("stt_stage_duration_seconds",
+                                       "Duration of each pipeline stage.", STAGE_BUCKETS, label="stage")
+        self.real_time_factor = Histogram("stt_real_time_factor",
+                                          "Processing time divided by audio duration per request.",
+                                          RTF_BUCKETS)
+        self.jobs_total = {}
+        self.audio_seconds_total = 0.0
+        self._lock = threading.Lock()
+    
+    def observe_run(self, timings, total_time, audio_seconds):
+        """Record one finished pipeline run."""
+        for name, duration in timings.items():
+            self.stage_seconds.observe(duration, name)
+        self.stage_seconds.observe(total_time, "Total")
+        if audio_seconds:
+            self.real_time_factor.observe(total_time / audio_seconds)
+            with self._lock:
+                self.audio_seconds_total += audio_seconds
+    
+    def count_job(self, status):
+        with self._lock:
+            self.jobs_total[status] = self.jobs_total.get(status, 0) + 1
+    
+    def render(self, gauges):
+        """Prometheus text exposition; `gauges` maps name -> (help, value or {label: value})."""
+        lines = self.stage_seconds.render() + self.real_time_factor.render()
         
-        # Detect language from first chunk if not specified
-        if detected_language is None and 'language' in result:
-            detected_language = result['language']
-            print(f"🌐 Detected language: {detected_language}")
+        with self._lock:
+            lines += ["# HELP stt_jobs_total Finished jobs by status.", "# TYPE stt_jobs_total counter"]
+            lines += [f'stt_jobs_total{{status="{_label_value(status)}"}} {count}'
+                      for status, count in sorted(self.jobs_total.items())]
+            lines += ["# HELP stt_audio_seconds_total Audio processed in seconds.",
+                      "# TYPE stt_audio_seconds_total counter",
+                      f"stt_audio_seconds_total {self.audio_seconds_total}"]
         
-        chunk_results.append((result['segments'], start_time))
+        for name, (help_text, value) in gauges.items():
+            metric_type = "counter" if name.endswith("_total") else "gauge"
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+            if isinstance(value, dict):
+                label, values = value["label"], value["values"]
+                lines += [f'{name}{{{label}="{_label_value(k)}"}} {v}' for k, v in sorted(values.items())]
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def file_sha256(path, block_size=1024 * 1024):
+    """SHA-256 of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_sortformer(device):
+    """Load the Sortformer diarization model onto `device`."""
+    sort_model = SortformerEncLabelModel.from_pretrained(SORTFORMER_MODEL)
+    sort_model.eval().to(device)
+    return ExclusiveModel(sort_model)
+
+
+def load_whisper(device, compute_type, language):
+    """Load the WhisperX pipeline onto `device`."""
+    return ExclusiveModel(whisperx.load_model(WHISPER_MODEL_SIZE, device,
+                                              compute_type=compute_type, language=language))
+
+
+def probe_pcm_wav(input_file):
+    """
+    Check whether a file is already mono 16kHz 16-bit PCM WAV.
+    
+    Only the RIFF header is read. Returns (data_offset, n_samples) when the
+    file can be used as-is, otherwise None.
+    """
+    file_size = os.path.getsize(input_file)
+    with open(input_file, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            return None
         
-        # Clear some memory between chunks
-        if i % 5 == 0:
-            gc.collect()
+        fmt_ok = False
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size + (chunk_size & 1))
+                if len(fmt) < 16:
+                    return None
+                audio_format, channels, rate, _, _, bits = struct.unpack("<HHIIHH", fmt[:16])
+                fmt_ok = audio_format == 1 and channels == 1 and rate == SAMPLE_RATE and bits == 16
+                if not fmt_ok:
+                    return None
+            elif chunk_id == b"data":
+                if not fmt_ok:
+                    return None
+                data_offset = f.tell()
+                # Streamed WAVs may carry a placeholder size; trust the file length then
+                data_size = min(chunk_size, file_size - data_offset)
+                return data_offset, data_size // 2
+            else:
+                f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+def pcm16_to_float32(input_file, data_offset, n_samples, output_file, block_samples=SAMPLE_RATE * 60):
+    """Convert raw 16-bit PCM to float32 samples block by block (bounded memory)."""
+    with open(input_file, "rb") as f, open(output_file, "wb") as out:
+        f.seek(data_offset)
+        remaining = n_samples
+        while remaining > 0:
+            block = np.fromfile(f, dtype="<i2", count=min(block_samples, remaining))
+            if len(block) == 0:
+                break
+            remaining -= len(block)
+            samples = block.astype(np.float32)
+            samples /= 32768.0
+            samples.tofile(out)
+
+
+def convert_to_float32(input_file, output_file):
+    """Convert any input to raw mono 16kHz float32 samples using FFmpeg."""
+    cmd = [
+        'ffmpeg', '-i', input_file,
+        '-ac', '1',  # mono
+        '-ar', str(SAMPLE_RATE),  # 16kHz
+        '-f', 'f32le',  # raw float32 samples
+        '-y',  # overwrite
+        output_file
+    ]
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+
+def decode_audio(input_file):
+    """
+    Decode audio once to a mono 16kHz float32 buffer shared by every stage.
+    
+    Raw float32 samples are written next to the input, by FFmpeg or, when the
+    input already is mono 16kHz PCM WAV, by a direct sample conversion. Inputs
+    longer than MMAP_MIN_SECONDS are memory-mapped instead of read into RAM;
+    the raw file is unlinked right away, the mapping keeps it alive until
+    released. Stages working on a mapped buffer hand processed ranges back
+    with release_pages, which keeps peak RSS flat for long lectures.
+    """
+    raw_file = os.path.splitext(input_file)[0] + "_mono16k.f32"
     
-    # Merge all segments
-    print(f"🔗 Merging {len(chunk_results)} chunks...")
-    merged_segments = merge_segments_from_chunks(chunk_results)
-    print(f"✅ Merged into {len(merged_segments)} segments")
+    pcm_layout = probe_pcm_wav(input_file)
+    if pcm_layout is not None:
+        # Already in the target format (e.g. from the gRPC media service): skip FFmpeg
+        print("⚡ Input is mono 16kHz PCM WAV, skipping conversion")
+        pcm16_to_float32(input_file, *pcm_layout, raw_file)
+    else:
+        convert_to_float32(input_file, raw_file)
     
-    return {
-        'segments': merged_segments,
-        'language': detected_language or 'en'
-    }
+    try:
+        n_samples = os.path.getsize(raw_file) // 4
+        if n_samples / SAMPLE_RATE >= MMAP_MIN_SECONDS:
+            with open(raw_file, "rb") as f:
+                # Private (copy-on-write) mapping so consumers may treat the buffer as writable
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            return np.frombuffer(mapping, dtype=np.float32)
+        return np.fromfile(raw_file, dtype=np.float32)
+    finally:
+        os.remove(raw_file)
 
 
-def format_time(seconds):
-    """Convert seconds to SRT time format."""
-    h = int(seconds // 3600)
-    m = int((seconds % 3600) // 60)
-    s = int(seconds % 60)
-    ms = int((seconds % 1) * 1000)
-    return f"{h:02}:{m:02}:{s:02},{ms:03}"
+def diarize_audio(sort_model, audio_array, batch_size=1):
+    """
+    Run Sortformer on the decoded buffer (or a list of windows of it)
+    instead of re-reading the file.
+    
+    On CUDA it runs on a side stream so its kernels can overlap with the
+    alignment model, which uses the default stream.
+    """
+    if torch.cuda.is_available():
+        with torch.cuda.stream(torch.cuda.Stream()):
+            result = sort_model.diarize(audio=audio_array, sample_rate=SAMPLE_RATE,
+                                        batch_size=batch_size, include_tensor_outputs=True)
+        torch.cuda.synchronize()
+        return result
+    return sort_model.diarize(audio=audio_array, sample_rate=SAMPLE_RATE,
+                              batch_size=batch_size, include_tensor_outputs=True)
 
 
-def get_segment_speaker(segment):
-    """Determine primary speaker from word-level assignments."""
-    if "words" not in segment or not segment["words"]:
-        return "Unknown"
+def diarization_windows(n_samples, window, overlap):
+    """(start_sample, end_sample) windows covering the audio with `overlap` seconds shared."""
+    window_samples = int(window * SAMPLE_RATE)
+    step_samples = window_samples - int(overlap * SAMPLE_RATE)
+    windows = []
+    start = 0
+    while True:
+        end = min(start + window_samples, n_samples)
+        windows.append((start, end))
+        if end >= n_samples:
+            return windows
+        start += step_samples
+
+
+def diarize_turns(sort_model, audio_array, window=DIAR_WINDOW_SECONDS, overlap=DIAR_OVERLAP_SECONDS,
+                  batch_size=DIAR_BATCH_SIZE):
+    """
+    Diarize the buffer and return speaker turns on the global timeline.
     
-    speaker_counts = {}
-    for word in segment["words"]:
-        speaker = word.get("speaker", "Unknown")
-        speaker_counts[speaker] = speaker_counts.get(speaker, 0) + 1
+    Audio up to one window long is diarized in a single call. Longer audio is
+    split into overlapping windows which are diarized `batch_size` at a time
+    and stitched with SpeakerStitcher, so memory is bounded by one batch of
+    windows and time grows linearly with duration. Each window's speakers
+    carry spectral profiles (turn_profiles) so that they keep their labels
+    across windows even when they are silent where windows overlap.
+    """
+    if len(audio_array) <= window * SAMPLE_RATE:
+        sort_segments, _ = diarize_audio(sort_model, audio_array)
+        return parse_sortformer_output(sort_segments)
     
-    return max(speaker_counts, key=speaker_counts.get) if speaker_counts else "Unknown"
+    windows = diarization_windows(len(audio_array), window, overlap)
+    print(f"🗣 Diarizing {len(windows)} windows of {window:.0f}s (batch_size={batch_size})")
+    
+    stitcher = SpeakerStitcher(SPEAKER_MATCH_SIMILARITY)
+    for first in range(0, len(windows), batch_size):
+        batch = windows[first:first + batch_size]
+        sort_segments, _ = diarize_audio(sort_model, [audio_array[start:end] for start, end in batch],
+                                         batch_size=batch_size)
+        for (start, end), window_segments in zip(batch, sort_segments):
+            offset = start / SAMPLE_RATE
+            turns = [dict(turn, start_time=turn["start_time"] + offset, end_time=turn["end_time"] + offset)
+                     for turn in parse_sortformer_output([window_segments])]
+            stitcher.add(turns, offset, end / SAMPLE_RATE, turn_profiles(audio_array, turns))
+        release_pages(audio_array, 0, batch[-1][1])
+    
+    return stitcher.result()
+
+
+def get_audio_duration(audio_file):
+    """Get audio duration using FFprobe."""
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'format=duration',
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        audio_file
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip())
+
+
+def speaker_profiles(audio_array, sample_rate=SAMPLE_RATE):
+    """
+    Loudness-normalized log band energies of each SPEAKER_WINDOW of speech.
+    
+    A cheap stand-in for speaker embeddings: the long-term spectral envelope
+    mostly reflects the speaker's voice and channel, not the words.
+    """
+    frame_samples = int(VAD_FRAME * sample_rate)
+    window_frames = int(SPEAKER_WINDOW / VAD_FRAME)
+    regions = detect_speech_regions(frame_energy_db(audio_array, frame_samples), VAD_FRAME)
+    
+    freqs = np.fft.rfftfreq(frame_samples, 1 / sample_rate)
+    band = np.digitize(freqs, np.geomspace(100, 4000, SPEAKER_BANDS + 1)) - 1
+    valid = (band >= 0) & (band < SPEAKER_BANDS)
+    taper = np.hanning(frame_samples).astype(np.float32)
+    
+    profiles = []
+    for start, end in regions:
+        for first in range(start, end - window_frames + 1, window_frames):
+            block = np.asarray(audio_array[first * frame_samples:(first + window_frames) * frame_samples],
+                               dtype=np.float32).reshape(window_frames, frame_samples)
+            power = np.square(np.abs(np.fft.rfft(block * taper, axis=1))).mean(axis=0)
+            bands = np.log(np.bincount(band[valid], weights=power[valid], minlength=SPEAKER_BANDS) + 1e-10)
+            profiles.append(bands - bands.mean())
+    return np.array(profiles)
 
 
-def save_as_srt(segments, output_path):
-    """Save segments as SRT file."""
-    with open(output_path, "w", encoding="utf-8") as f:
-        for i, seg in enumerate(segments, 1):
-            start = format_time(seg["start"])
-            end = format_time(seg["end"])
-            speaker = get_segment_speaker(seg)
-            text = seg["text"].strip()
-            f.write(f"{i}\n{start} --> {end}\n[{speaker}] {text}\n\n")
+def is_single_speaker(profiles, separation=SPEAKER_SEPARATION, iterations=10):
+    """
+    Whether spectral profiles look like one speaker.
+    
+    Profiles are split in two with k-means (seeded along the principal axis).
+    Two speakers are assumed when the centroids are more than `separation`
+    times the within-cluster spread apart, however small the second cluster
+    is: students speaking for a minute of a lecture clip still need Sortformer.
+    """
+    if len(profiles) < 2:
+        return True
+    
+    centered = profiles - profiles.mean(axis=0)
+    _, _, vt = np.linalg.svd(centered, full_matrices=False)
+    labels = centered @ vt[0] > 0
+    for _ in range(iterations):
+        if labels.all() or not labels.any():
+            return True
+        c1 = profiles[labels].mean(axis=0)
+        c0 = profiles[~labels].mean(axis=0)
+        new_labels = np.linalg.norm(profiles - c1, axis=1) < np.linalg.norm(profiles - c0, axis=1)
+        if (new_labels == labels).all():
+            break
+        labels = new_labels
+    
+    within = np.concatenate([profiles[labels] - c1, profiles[~labels] - c0])
+    spread = np.sqrt(np.square(within).sum(axis=1).mean())
+    return np.linalg.norm(c1 - c0) < separation * spread
 
 
-def assign_word_speakers(words, diar_segments):
-    """Assign speakers to words based on time overlap."""
-    result = []
-    for word in words:
-        w_start, w_end = word.get("start"), word.get("end")
-        if w_start is None or w_end is None:
+def turn_profiles(audio_array, turns, max_seconds=SPEAKER_PROFILE_SECONDS):
+    """
+    Mean spectral profile (see speaker_profiles) of each speaker's turns,
+    from their longest turns up to `max_seconds` of audio.
+    
+    Speakers with too little speech for a profile are left out.
+    """
+    pieces = {}
+    lengths = {}
+    for turn in sorted(turns, key=lambda t: t["start_time"] - t["end_time"]):
+        speaker = turn["speaker"]
+        if lengths.get(speaker, 0) >= max_seconds * SAMPLE_RATE:
             continue
+        piece = audio_array[int(turn["start_time"] * SAMPLE_RATE):int(turn["end_time"] * SAMPLE_RATE)]
+        pieces.setdefault(speaker, []).append(piece)
+        lengths[speaker] = lengths.get(speaker, 0) + len(piece)
+    
+    profiles = {}
+    for speaker, speaker_pieces in pieces.items():
+        windows = speaker_profiles(np.concatenate(speaker_pieces))
+        if len(windows):
+            profiles[speaker] = windows.mean(axis=0).tolist()
+    return profiles
+
+
+def single_speaker_turns(duration):
+    """Diarization result labelling the whole recording as one speaker."""
+    return [{"start_time": 0.0, "end_time": duration, "speaker": "speaker_0"}]
+
+
+def align_in_windows(segments, align_model, metadata, audio_array, device, window=ALIGN_WINDOW_SECONDS):
+    """
+    Align segments window by window against views of the audio buffer.
+    
+    Consecutive segments are grouped into runs spanning at most `window`
+    seconds; each run is aligned against just its slice of audio with times
+    shifted in and back out. Pages of a memory-mapped buffer are released
+    after each window, so memory stays flat however long the lecture is.
+    """
+    aligned = []
+    i = 0
+    while i < len(segments):
+        j = i + 1
+        while j < len(segments) and segments[j]["end"] - segments[i]["start"] <= window:
+            j += 1
+        group = segments[i:j]
         
-        speaker = "Unknown"
-        for seg in diar_segments:
-            if w_start >= seg["start_time"] and w_end <= seg["end_time"]:
-                speaker = seg["speaker"]
-                break
+        window_start = max(group[0]["start"] - ALIGN_MARGIN, 0.0)
+        window_end = max(seg["end"] for seg in group) + ALIGN_MARGIN
+        view = audio_array[int(window_start * SAMPLE_RATE):int(window_end * SAMPLE_RATE)]
         
-        result.append({
-            "word": word["word"],
-            "start": w_start,
-            "end": w_end,
-            "score": word.get("score"),
-            "speaker": speaker
-        })
-    return result
+        shifted = [shift_segment(seg, -window_start) for seg in group]
+        result = whisperx.align(shifted, align_model, metadata, view, device)
+        aligned.extend(shift_segment(seg, window_start) for seg in result["segments"])
+        
+        release_pages(audio_array, 0, int(window_end * SAMPLE_RATE))
+        i = j
+    return aligned
 
 
 def parse_sortformer_output(sort_segments):
@@ -305,10 +769,25 @@ def parse_sortformer_output(sort_segments):
     return diar_segments
 
 
-def run(audio_file, output_srt, output_json, device="cuda", compute_type="int8", lang_code=None):
-    """Main processing pipeline with chunking."""
+def run(audio_file, device="cuda", compute_type="int8", lang_code=None, on_event=None,
+        diarize="auto", align=True, batcher=None):
+    """
+    Main processing pipeline with chunking.
+    
+    Returns (language, transcript, segments); formatting is left to the caller.
+    
+    `diarize` is "on", "off" (every speaker is "Unknown") or "auto", which skips
+    Sortformer for clips up to SINGLE_SPEAKER_MAX_SECONDS that look like a single
+    speaker. `align=False` skips word alignment, leaving segment-level times.
+    `batcher` (a ChunkBatcher) shares transcription calls with other files.
+    
+    `on_event(name, data)` receives partial results as they become available:
+    "segments" per finished chunk, "transcript" once transcription is done,
+    "aligned" after word alignment and "speakers" after diarization.
+    """
     start_time = time.time()
     timings = {}
+    emit = on_event or (lambda name, data: None)
     
     def step(name, func, *args, **kwargs):
         t0 = time.time()
@@ -316,126 +795,660 @@ def run(audio_file, output_srt, output_json, device="cuda", compute_type="int8",
         timings[name] = time.time() - t0
         return result
     
+    def cached_step(name, stage, params, func):
+        """Return (output, cache_hit) for `stage`, running and caching `func` on a miss."""
+        key = STAGE_CACHE.key(audio_hash, stage, params)
+        t0 = time.time()
+        value = STAGE_CACHE.get(key)
+        if value is not None:
+            timings[f"{name} (cache hit)"] = time.time() - t0
+            return value, True
+        value = func()
+        STAGE_CACHE.put(key, value)
+        return value, False
+    
+    decoded = {}
+    decode_lock = threading.Lock()
+    
+    def get_audio():
+        # Decode audio once, and only if a stage actually needs it
+        with decode_lock:
+            if "audio" not in decoded:
+                decoded["audio"] = step("Audio Decode", decode_audio, audio_file)
+            return decoded["audio"]
+    
     print(f"🚀 Starting at {datetime.now().strftime('%H:%M:%S')}")
     
-    # Convert audio first (memory efficient)
-    processed_audio = step("Audio Conversion", convert_to_mono_16k, audio_file)
+    audio_hash = step("Audio Hash", file_sha256, audio_file)
     
-    # Load WhisperX model
-    model = step("WhisperX Model Load", whisperx.load_model, "small", device, compute_type=compute_type)
+    # Diarization with Sortformer only needs the audio, so it runs on its own
+    # thread while Whisper transcribes and aligns
+    def diarize_audio_file():
+        audio = get_audio()
+        duration = len(audio) / SAMPLE_RATE
+        if diarize == "auto" and duration <= SINGLE_SPEAKER_MAX_SECONDS:
+            profiles = step("Speaker Check", speaker_profiles, audio)
+            if is_single_speaker(profiles):
+                print("👤 Single speaker detected, skipping Sortformer")
+                return single_speaker_turns(duration)
+        sort_model = step("Sortformer Load", MODEL_POOL.get,
+                          ("sortformer", SORTFORMER_MODEL, None, None, device),
+                          load_sortformer, device)
+        return step("Sortformer Diarization", diarize_turns, sort_model, audio)
     
-    # Transcribe with chunking
-    result = step("Chunked Transcription", transcribe_with_chunking, 
-                  processed_audio, model, device, 
-                  chunk_length=CHUNK_LENGTH, stride=STRIDE, language=lang_code)
-    segments, lang_code = result["segments"], result["language"]
+    diarization = None
+    if diarize != "off":
+        diarization = DIARIZATION_EXECUTOR.submit(
+            cached_step, "Sortformer Diarization", "diarization", {
+                "model": SORTFORMER_MODEL, "window": DIAR_WINDOW_SECONDS, "overlap": DIAR_OVERLAP_SECONDS,
+                "speaker_check": SPEAKER_SEPARATION if diarize == "auto" else None,
+            }, diarize_audio_file)
     
-    del model
-    gc.collect()
+    live = {}
+    
+    def transcribe():
+        # Get WhisperX model from the resident pool
+        model = step("WhisperX Model Load", MODEL_POOL.get,
+                     ("whisper", WHISPER_MODEL_SIZE, compute_type, lang_code, device),
+                     load_whisper, device, compute_type, lang_code)
+        
+        # Transcribe with chunking
+        audio = get_audio()
+        
+        def on_segments(new, done, total):
+            live["chunks"] = total
+            emit("segments", {"segments": new, "chunks_done": done, "chunks_total": total})
+        
+        with batcher.participant() if batcher is not None else nullcontext():
+            result = step("Chunked Transcription", transcribe_with_chunking,
+                          audio, model, device,
+                          chunk_length=CHUNK_LENGTH, stride=STRIDE, language=lang_code,
+                          on_segments=on_segments,
+                          keep_chunk_results=False, batcher=batcher)
+        # Cache the merged segments, which the pipeline holds anyway, rather
+        # than every raw chunk result
+        return {"segments": result["segments"], "chunks": live.get("chunks", 0), "language": result["language"]}
+    
+    transcription, cache_hit = cached_step("Chunked Transcription", "transcription", {
+        "model": WHISPER_MODEL_SIZE, "compute_type": compute_type, "language": lang_code,
+        "chunking": CHUNKING_MODE, "chunk_length": CHUNK_LENGTH, "stride": STRIDE, "merged": True,
+    }, transcribe)
+    lang_code = transcription["language"]
+    segments = transcription.pop("segments")
+    if cache_hit:
+        n_chunks = transcription["chunks"]
+        emit("segments", {"segments": segments, "chunks_done": n_chunks, "chunks_total": n_chunks})
+    del transcription
     
     # Generate transcript
     transcript = " ".join([s["text"] for s in segments])
+    emit("transcript", {"language": lang_code, "transcript": transcript})
     
-    # Align words (load full audio for alignment - this is necessary for WhisperX)
-    try:
-        audio = step("Audio Load for Alignment", whisperx.load_audio, processed_audio)
-        align_model, metadata = step("Align Model Load", whisperx.load_align_model, lang_code, device)
-        result = step("Alignment", whisperx.align, segments, align_model, metadata, audio, device)
-        segments = result["segments"]
-        del align_model, audio
-        gc.collect()
-    except Exception as e:
-        print(f"⚠ Alignment failed: {e}, continuing without alignment")
+    # Align words against windows of the shared audio buffer
+    def align_segments():
+        align_model, metadata = step("Align Model Load", MODEL_POOL.get,
+                                     ("align", lang_code, None, lang_code, device),
+                                     whisperx.load_align_model, lang_code, device)
+        return step("Alignment", align_in_windows, segments, align_model, metadata, get_audio(), device)
     
-    # Diarization with Sortformer
-    sort_model = step("Sortformer Load", SortformerEncLabelModel.from_pretrained, 
-                      "nvidia/diar_streaming_sortformer_4spk-v2")
-    sort_model.eval().to(device)
-    sort_segments, _ = step("Sortformer Diarization", sort_model.diarize, 
-                           processed_audio, batch_size=1, include_tensor_outputs=True)
-    del sort_model
-    gc.collect()
+    if align:
+        try:
+            segments_hash = hashlib.sha256(
+                json.dumps(segments, sort_keys=True, default=float).encode("utf-8")).hexdigest()
+            segments, _ = cached_step("Alignment", "alignment",
+                                      {"language": lang_code, "segments": segments_hash}, align_segments)
+            # Words repeated by partially overlapping chunk segments only have timestamps now
+            segments = step("Word Dedup", dedup_words, sorted(segments, key=lambda s: s["start"]))
+            emit("aligned", {"segments": segments})
+        except Exception as e:
+            print(f"⚠ Alignment failed: {e}, continuing without alignment")
     
-    # Parse diarization output
-    diar_segments = parse_sortformer_output(sort_segments)
+    # Join diarization, which ran alongside transcription and alignment
+    diar_segments = []
+    if diarization is not None:
+        diar_segments, _ = step("Diarization Wait", diarization.result)
     
-    # Assign speakers to words
-    for seg in segments:
-        if "words" in seg:
-            seg["words"] = assign_word_speakers(seg["words"], diar_segments)
+    # Assign speakers to words and segments
+    assign_speakers(segments, diar_segments)
+    emit("speakers", {"segments": segments})
     
-    # Save outputs
-    save_as_srt(segments, output_srt)
-    with open(output_json, "w", encoding="utf-8") as f:
-        json.dump({"segments": segments}, f, ensure_ascii=False, indent=2)
+    audio_seconds = len(decoded["audio"]) / SAMPLE_RATE if "audio" in decoded else None
     
-    # Cleanup
-    if os.path.exists(processed_audio):
-        os.remove(processed_audio)
+    # Release the decoded audio (and its mapping)
+    decoded.clear()
+    gc.collect()
     
     # Summary
     total_time = time.time() - start_time
+    METRICS.observe_run(timings, total_time, audio_seconds)
     print(f"\n📊 SUMMARY: Language={lang_code}, Segments={len(segments)}, Time={total_time:.2f}s")
+    if audio_seconds:
+        print(f"📊 Real-time factor: {total_time / audio_seconds:.3f}")
     print(f"📊 Timing breakdown:")
     for name, duration in timings.items():
         print(f"   {name}: {duration:.2f}s")
     
-    return lang_code, transcript
+    return lang_code, transcript, segments
 
 
-@app.post("/process_audio/")
-async def process_audio(file: UploadFile = File(...), source_lan: str = Form(None)):
-    """Process audio file with transcription and diarization."""
+class Job:
+    """State of one transcription request."""
+    
+    def __init__(self, job_id, workdir):
+        self.id = job_id
+        self.workdir = workdir
+        self.status = "queued"  # queued -> running -> done | error
+        self.result = None
+        self.events = []  # (name, data) in emission order, replayed to every stream
+        self.cost_mb = 0.0  # estimated working memory, reserved from ADMISSION while running
+        self.created_at = time.time()
+        self.finished_at = None
+    
+    def emit(self, name, data):
+        self.events.append((name, data))
+    
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "estimated_mb": round(self.cost_mb, 1),
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class AdmissionController:
+    """
+    Admits jobs against a working-memory budget in arrival order.
+    
+    A job waits until it is first in line and its estimated cost fits in what
+    is left of the budget. A job larger than the whole budget is admitted once
+    nothing else is running, so oversized inputs are serialized, not rejected.
+    """
+    
+    def __init__(self, budget_mb):
+        self.budget_mb = budget_mb
+        self._in_use_mb = 0.0
+        self._active = 0
+        self._waiting = []  # tickets in arrival order
+        self._cond = threading.Condition()
+    
+    @contextmanager
+    def admit(self, ticket, cost_mb):
+        """Block until `cost_mb` can be reserved, and hold it for the with-block."""
+        with self._cond:
+            self._waiting.append(ticket)
+            self._cond.wait_for(lambda: self._waiting[0] == ticket and self._fits(cost_mb))
+            self._waiting.pop(0)
+            self._in_use_mb += cost_mb
+            self._active += 1
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_use_mb -= cost_mb
+                self._active -= 1
+                self._cond.notify_all()
+    
+    def position(self, ticket):
+        """1-based position among jobs waiting for memory, or 0 if not waiting."""
+        with self._cond:
+            return self._waiting.index(ticket) + 1 if ticket in self._waiting else 0
+    
+    def waiting(self):
+        with self._cond:
+            return len(self._waiting)
+    
+    def in_use_mb(self):
+        with self._cond:
+            return self._in_use_mb
+    
+    def _fits(self, cost_mb):
+        return self._active == 0 or self._in_use_mb + cost_mb <= self.budget_mb
+
+
+ADMISSION = AdmissionController(ADMISSION_BUDGET_MB)
+
+
+def estimate_job_cost_mb(input_path):
+    """
+    Estimate a job's peak working memory (MB) from its input duration.
+    
+    Inputs long enough to be memory-mapped keep only a bounded part of the
+    audio resident, so their cost stops growing at MMAP_MIN_SECONDS.
+    """
     try:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # Save uploaded file
-            input_path = os.path.join(tmpdir, file.filename)
-            with open(input_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            
-            # Set output paths
-            output_srt = os.path.join(tmpdir, "output.srt")
-            output_json = os.path.join(tmpdir, "output.json")
-            
-            # Auto-detect language if needed
-            if source_lan == 'auto':
-                source_lan = None
-            
-            # Process
-            detect_lan, transcript = run(
-                audio_file=input_path,
-                output_srt=output_srt,
-                output_json=output_json,
-                device="cuda" if torch.cuda.is_available() else "cpu",
-                compute_type="int8",
-                lang_code=source_lan
-            )
-            
-            # Read results
-            with open(output_srt, "r", encoding="utf-8") as f:
-                srt_data = f.read()
-            with open(output_json, "r", encoding="utf-8") as f:
-                json_data = json.load(f)
+        probe = probe_pcm_wav(input_path)
+        seconds = probe[1] / SAMPLE_RATE if probe else get_audio_duration(input_path)
+    except (subprocess.CalledProcessError, ValueError, OSError):
+        seconds = os.path.getsize(input_path) / ADMISSION_FALLBACK_BYTES_PER_SECOND
+    resident_seconds = min(seconds, MMAP_MIN_SECONDS)
+    audio_mb = resident_seconds * SAMPLE_RATE * 4 * ADMISSION_AUDIO_COPIES / (1024 ** 2)
+    return ADMISSION_BASE_MB + audio_mb
+
+
+class JobManager:
+    """
+    Runs transcription jobs on a fixed pool of worker threads.
+    
+    The blocking pipeline never runs on the event loop, so health checks and
+    status polls stay responsive while lectures are being transcribed.
+    Finished jobs are kept for JOB_TTL_SECONDS.
+    """
+    
+    def __init__(self, workers, batch_workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stt-worker")
+        # Files of multi-file batches run on their own pool so they can share inference calls
+        self._batch_executor = ThreadPoolExecutor(max_workers=batch_workers, thread_name_prefix="stt-batch")
+        self._jobs = {}
+        self._batches = {}  # batch id -> [(filename, job)]
+        self._queued = []
+        self._lock = threading.Lock()
+    
+    def create(self):
+        """Register a new job with its own working directory."""
+        job = Job(uuid.uuid4().hex, tempfile.mkdtemp(prefix="stt_job_"))
+        with self._lock:
+            self._expire()
+            self._jobs[job.id] = job
+        return job
+    
+    def submit(self, job, func, *args, **kwargs):
+        """Queue `func(*args, **kwargs)` for `job`; returns a concurrent Future."""
+        with self._lock:
+            self._queued.append(job.id)
+        return self._executor.submit(self._run, job, func, *args, **kwargs)
+    
+    def submit_batch(self, files, func, *args, **kwargs):
+        """
+        Queue `func(input_path, *args, on_event=job.emit, **kwargs)` for each
+        (filename, job, input_path) on the batch pool; returns the batch id.
+        """
+        batch_id = uuid.uuid4().hex
+        with self._lock:
+            self._batches[batch_id] = [(filename, job) for filename, job, _ in files]
+            self._queued.extend(job.id for _, job, _ in files)
+        for _, job, input_path in files:
+            self._batch_executor.submit(self._run, job, func, input_path, *args, on_event=job.emit, **kwargs)
+        return batch_id
+    
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def get_batch(self, batch_id):
+        with self._lock:
+            return self._batches.get(batch_id)
+    
+    def queue_position(self, job_id):
+        """
+        1-based position among jobs not yet started, or 0 once started.
         
-        return {
+        Jobs holding a worker but waiting for memory are ahead of those still
+        waiting for a worker.
+        """
+        admission_position = ADMISSION.position(job_id)
+        if admission_position:
+            return admission_position
+        with self._lock:
+            if job_id not in self._queued:
+                return 0
+            return ADMISSION.waiting() + self._queued.index(job_id) + 1
+    
+    def queue_depth(self):
+        with self._lock:
+            return len(self._queued) + ADMISSION.waiting()
+    
+    def running(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.status == "running")
+    
+    def _run(self, job, func, *args, **kwargs):
+        with self._lock:
+            self._queued.remove(job.id)
+        try:
+            with ADMISSION.admit(job.id, job.cost_mb):
+                job.status = "running"
+                job.result = func(*args, **kwargs)
+            job.status = "error" if job.result.get("status") == "error" else "done"
+        except Exception as e:
+            job.result = {"status": "error", "message": str(e)}
+            job.status = "error"
+        finally:
+            job.finished_at = time.time()
+            shutil.rmtree(job.workdir, ignore_errors=True)
+            job.emit(job.status, job.result)
+            METRICS.count_job(job.status)
+        return job.result
+    
+    def _expire(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at and now - job.finished_at > JOB_TTL_SECONDS]
+        for job_id in expired:
+            del self._jobs[job_id]
+        for batch_id, files in list(self._batches.items()):
+            if all(job.id not in self._jobs for _, job in files):
+                del self._batches[batch_id]
+
+
+JOBS = JobManager(STT_WORKERS, BATCH_FILES)
+
+
+def save_upload(file, workdir):
+    """Copy an uploaded file into `workdir` and return its path."""
+    input_path = os.path.join(workdir, os.path.basename(file.filename or "audio"))
+    with open(input_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+    return input_path
+
+
+def claim_artifact(artifact_id, workdir):
+    """Move an audio artifact left by the media service into `workdir` and return its path."""
+    if not ARTIFACT_ID.fullmatch(artifact_id):
+        raise ValueError(f"Invalid audio reference: {artifact_id!r}")
+    input_path = os.path.join(workdir, "audio.wav")
+    try:
+        shutil.move(os.path.join(ARTIFACT_DIR, f"{artifact_id}.wav"), input_path)
+    except FileNotFoundError:
+        raise ValueError(f"Unknown or expired audio reference: {artifact_id}")
+    return input_path
+
+
+def parse_formats(formats):
+    """Split a comma-separated format list, keeping only known formats."""
+    requested = [f.strip().lower() for f in (formats or DEFAULT_FORMATS).split(",")]
+    return [f for f in requested if f in OUTPUT_FORMATS] or DEFAULT_FORMATS.split(",")
+
+
+def parse_diarize(value):
+    """Map a diarize form value to "auto", "on" or "off" (booleans are accepted too)."""
+    value = (value or "auto").strip().lower()
+    if value in DIARIZE_MODES:
+        return value
+    return "off" if value in ("0", "false", "no") else "on" if value in ("1", "true", "yes") else "auto"
+
+
+def parse_flag(value, default=True):
+    """Read a boolean form value such as "1", "true" or "no"."""
+    if value is None or value == "":
+        return default
+    return value.strip().lower() not in ("0", "false", "no", "off")
+
+
+def transcribe_file(input_path, source_lan=None, formats=DEFAULT_FORMATS, on_event=None,
+                    diarize="auto", word_timestamps=True, batcher=None):
+    """Run the pipeline on a saved upload and build the response payload in memory."""
+    try:
+        # Auto-detect language if needed
+        if source_lan == 'auto':
+            source_lan = None
+        
+        # Process
+        detect_lan, transcript, segments = run(
+            audio_file=input_path,
+            device="cuda" if torch.cuda.is_available() else "cpu",
+            compute_type="int8",
+            lang_code=source_lan,
+            on_event=on_event,
+            diarize=diarize,
+            align=word_timestamps,
+            batcher=batcher
+        )
+        
+        response = {
             "status": "success",
             "message": "Processing complete",
-            "srt_content": srt_data,
-            "json_content": json_data,
             "only_transcript": transcript,
             "source_lan": detect_lan
         }
+        for name in parse_formats(formats):
+            key, render = OUTPUT_FORMATS[name]
+            response[key] = render(segments)
+        return response
     
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 
+async def save_job_upload(file, audio_ref=None):
+    """
+    Save an upload, or claim the media service's artifact `audio_ref`, off the
+    event loop into a new job; returns (job, input_path).
+    """
+    if file is None and not audio_ref:
+        raise ValueError("Send an audio file or an audio_ref")
+    job = JOBS.create()
+    try:
+        if file is None:
+            input_path = await run_in_threadpool(claim_artifact, audio_ref, job.workdir)
+        else:
+            input_path = await run_in_threadpool(save_upload, file, job.workdir)
+        job.cost_mb = await run_in_threadpool(estimate_job_cost_mb, input_path)
+    except Exception as e:
+        job.result = {"status": "error", "message": str(e)}
+        job.status = "error"
+        job.finished_at = time.time()
+        shutil.rmtree(job.workdir, ignore_errors=True)
+        raise
+    return job, input_path
+
+
+async def submit_upload(file, source_lan, formats, diarize="auto", word_timestamps="1", audio_ref=None):
+    """Save an upload (or claim an artifact) off the event loop and queue it as a job."""
+    job, input_path = await save_job_upload(file, audio_ref)
+    future = JOBS.submit(job, transcribe_file, input_path, source_lan, formats, on_event=job.emit,
+                         diarize=parse_diarize(diarize), word_timestamps=parse_flag(word_timestamps))
+    return job, future
+
+
+@app.post("/process_audio/")
+async def process_audio(file: UploadFile = File(None), source_lan: str = Form(None),
+                        formats: str = Form(DEFAULT_FORMATS), diarize: str = Form("auto"),
+                        word_timestamps: str = Form("1"), audio_ref: str = Form(None)):
+    """
+    Process audio file with transcription and diarization (waits for the result).
+    
+    `formats` is a comma-separated subset of srt, vtt, text, compact and json;
+    json (full per-word dicts) is only included when asked for.
+    `diarize` is auto (skip Sortformer for short single-speaker clips), on or
+    off; `word_timestamps=0` skips word alignment.
+    Instead of `file`, `audio_ref` names audio the media service already
+    extracted into the shared artifact directory (ExtractAudioArtifact).
+    """
+    try:
+        _, future = await submit_upload(file, source_lan, formats, diarize, word_timestamps, audio_ref)
+        return await asyncio.wrap_future(future)
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@app.post("/jobs/")
+async def submit_job(file: UploadFile = File(None), source_lan: str = Form(None),
+                     formats: str = Form(DEFAULT_FORMATS), diarize: str = Form("auto"),
+                     word_timestamps: str = Form("1"), audio_ref: str = Form(None)):
+    """Queue an audio file (or a media service `audio_ref`) for processing and return its job id immediately."""
+    try:
+        job, _ = await submit_upload(file, source_lan, formats, diarize, word_timestamps, audio_ref)
+        return {**job.to_dict(), "queue_position": JOBS.queue_position(job.id)}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@app.get("/jobs/{job_id}/")
+async def job_status(job_id: str):
+    """Current state of a job."""
+    job = JOBS.get(job_id)
+    if job is None:
+        return JSONResponse({"status": "error", "message": "Unknown job"}, status_code=404)
+    return {**job.to_dict(), "queue_position": JOBS.queue_position(job_id)}
+
+
+@app.get("/jobs/{job_id}/result/")
+async def job_result(job_id: str):
+    """Result of a finished job; 202 while it is still queued or running."""
+    job = JOBS.get(job_id)
+    if job is None:
+        return JSONResponse({"status": "error", "message": "Unknown job"}, status_code=404)
+    if job.result is None:
+        return JSONResponse({**job.to_dict(), "queue_position": JOBS.queue_position(job_id)},
+                            status_code=202)
+    return job.result
+
+
+def batch_files(files):
+    return [{"filename": filename, **job.to_dict(), "queue_position": JOBS.queue_position(job.id)}
+            for filename, job in files]
+
+
+@app.post("/batch/")
+async def submit_batch(files: list[UploadFile] = File(...), source_lan: str = Form(None),
+                       formats: str = Form(DEFAULT_FORMATS), diarize: str = Form("auto"),
+                       word_timestamps: str = Form("1")):
+    """
+    Queue many audio files (e.g. a whole course) as one batch.
+    
+    Up to STT_BATCH_FILES files are transcribed side by side with the same
+    resident models, their chunks sharing inference calls. Every file is also
+    a regular job; results arrive per file on /batch/{id}/events/ as each
+    finishes, or from each job's result endpoint.
+    """
+    saved = []
+    try:
+        for file in files:
+            job, input_path = await save_job_upload(file)
+            saved.append((file.filename, job, input_path))
+        batcher = ChunkBatcher(len(saved))
+        batch_id = JOBS.submit_batch(saved, transcribe_file, source_lan, formats,
+                                     diarize=parse_diarize(diarize),
+                                     word_timestamps=parse_flag(word_timestamps), batcher=batcher)
+        return {"batch_id": batch_id, "files": batch_files(JOBS.get_batch(batch_id))}
+    except Exception as e:
+        # Nothing was queued; drop the uploads saved so far
+        for _, job, _ in saved:
+            job.result = {"status": "error", "message": str(e)}
+            job.status = "error"
+            job.finished_at = time.time()
+            shutil.rmtree(job.workdir, ignore_errors=True)
+        return {"status": "error", "message": str(e)}
+
+
+@app.get("/batch/{batch_id}/")
+async def batch_status(batch_id: str):
+    """Current state of every file in a batch."""
+    files = JOBS.get_batch(batch_id)
+    if files is None:
+        return JSONResponse({"status": "error", "message": "Unknown batch"}, status_code=404)
+    return {"batch_id": batch_id, "files": batch_files(files)}
+
+
+async def batch_event_stream(files):
+    """Server-sent "file" events with each file's result as it finishes, then "done"."""
+    pending = list(files)
+    last_write = time.time()
+    while pending:
+        finished = [(filename, job) for filename, job in pending if job.finished_at is not None]
+        for filename, job in finished:
+            payload = json.dumps({"filename": filename, "job_id": job.id, **job.result},
+                                 ensure_ascii=False, default=float)
+            yield f"event: file\ndata: {payload}\n\n"
+            pending.remove((filename, job))
+        if finished:
+            last_write = time.time()
+        elif time.time() - last_write > SSE_KEEPALIVE_INTERVAL:
+            yield ": keep-alive\n\n"
+            last_write = time.time()
+        if pending:
+            await asyncio.sleep(SSE_POLL_INTERVAL)
+    summary = [{"filename": filename, "job_id": job.id, "status": job.status} for filename, job in files]
+    yield f"event: done\ndata: {json.dumps({'files': summary}, ensure_ascii=False)}\n\n"
+
+
+@app.get("/batch/{batch_id}/events/")
+async def batch_events(batch_id: str):
+    """Stream per-file results of a batch as server-sent events."""
+    files = JOBS.get_batch(batch_id)
+    if files is None:
+        return JSONResponse({"status": "error", "message": "Unknown batch"}, status_code=404)
+    return StreamingResponse(batch_event_stream(files), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def job_event_stream(job):
+    """Server-sent events for a job, replayed from its first event."""
+    sent = 0
+    last_write = time.time()
+    while True:
+        events = job.events[sent:]
+        for name, data in events:
+            payload = json.dumps(data, ensure_ascii=False, default=float)
+            yield f"event: {name}\ndata: {payload}\n\n"
+        sent += len(events)
+        
+        if job.finished_at is not None and sent == len(job.events):
+            break
+        if events:
+            last_write = time.time()
+        elif time.time() - last_write > SSE_KEEPALIVE_INTERVAL:
+            # Comment line keeps proxies from closing idle streams
+            yield ": keep-alive\n\n"
+            last_write = time.time()
+        await asyncio.sleep(SSE_POLL_INTERVAL)
+
+
+@app.get("/jobs/{job_id}/events/")
+async def job_events(job_id: str):
+    """
+    Stream a job's partial results as server-sent events.
+    
+    Events: "segments" (merged segments of each finished chunk), "transcript",
+    "aligned", "speakers", then "done" or "error" with the full result.
+    """
+    job = JOBS.get(job_id)
+    if job is None:
+        return JSONResponse({"status": "error", "message": "Unknown job"}, status_code=404)
+    return StreamingResponse(job_event_stream(job), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/health/")
+async def health():
+    """Liveness probe; answered even while workers are busy."""
+    return {"status": "ok", "queue_depth": JOBS.queue_depth(),
+            "admission_in_use_mb": round(ADMISSION.in_use_mb(), 1),
+            "admission_budget_mb": ADMISSION.budget_mb}
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: stage latency, real-time factor, queue depth, model loads, memory."""
+    gauges = {
+        "stt_queue_depth": ("Jobs waiting for a worker or for memory.", JOBS.queue_depth()),
+        "stt_admission_waiting": ("Jobs holding a worker but waiting for memory.", ADMISSION.waiting()),
+        "stt_admission_in_use_mb": ("Estimated working memory reserved by running jobs.",
+                                    ADMISSION.in_use_mb()),
+        "stt_jobs_running": ("Jobs currently being processed.", JOBS.running()),
+        "stt_model_loads_total": ("Model loads by kind since start.",
+                                  {"label": "kind", "values": dict(MODEL_POOL.load_counts)}),
+        "stt_model_pool_resident_mb": ("Estimated memory held by resident models.",
+                                       MODEL_POOL.resident_mb()),
+        # ru_maxrss is reported in kilobytes on Linux
+        "stt_peak_rss_bytes": ("Peak resident set size of the server process.",
+                               resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024),
+    }
+    if torch.cuda.is_available():
+        gauges["stt_cuda_peak_allocated_bytes"] = ("Peak CUDA memory allocated by torch.",
+                                                   torch.cuda.max_memory_allocated())
+    return PlainTextResponse(METRICS.render(gauges), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/clear_memory/")
 async def clear_memory():
-    """Clear CUDA memory cache."""
+    """Drop resident models and clear CUDA memory cache."""
     try:
         print("🧹 Clearing CUDA memory...")
-        gc.collect()
+        MODEL_POOL.clear()
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.ipc_collect()
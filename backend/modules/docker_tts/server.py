@@ -1,10 +1,16 @@
 import os
+import asyncio
+import time
+import uuid
 import numpy as np
 import soundfile as sf
 import torch
+from contextlib import asynccontextmanager
 from transformers import AutoModel
 from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse
+from starlette.background import BackgroundTask
 import tempfile
 
 # -------------------------
@@ -15,6 +21,102 @@ print(f"Using device: {device}")
 import os
 os.environ["HUGGING_FACE_HUB_TOKEN"] = os.getenv("HF_TOKEN")
 
+# -------------------------
+# Admission control
+# -------------------------
+ADMISSION_BUDGET_MB = float(os.environ.get("TTS_ADMISSION_MB", "8192"))
+MAX_QUEUE = int(os.environ.get("TTS_MAX_QUEUE", "32"))  # reject with 503 beyond this many waiting
+MODEL_MB = 3000.0  # IndicF5 weights plus vocoder, loaded for every request
+MB_PER_AUDIO_SECOND = 4.0  # mel frames, waveform and attention activations per second of speech
+CHARS_PER_SECOND = 12.0  # rough speaking rate used to predict output length
+OUTPUT_SAMPLE_RATE = 24000
+
+
+# Same controller as in mathocr/docker_ocr/server.py: each image is built from its own
+# directory (COPY . .), so the two servers cannot import a shared module.
+class AdmissionController:
+    """
+    Admits requests against a memory budget in arrival order.
+    
+    A request waits until it is first in line and its estimated cost fits in
+    what is left of the budget; one larger than the whole budget runs alone.
+    Tickets are strings so clients can look up their place in line.
+    """
+    
+    def __init__(self, budget_mb):
+        self.budget_mb = budget_mb
+        self.in_use_mb = 0.0
+        self.active = 0
+        self._waiting = []  # tickets in arrival order
+        self._running = set()
+        self._cond = asyncio.Condition()
+    
+    @asynccontextmanager
+    async def admit(self, ticket, cost_mb):
+        async with self._cond:
+            self._waiting.append(ticket)
+            try:
+                await self._cond.wait_for(lambda: self._waiting[0] == ticket and self._fits(cost_mb))
+            finally:
+                # Also reached when the client disconnects while queued
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+            self.in_use_mb += cost_mb
+            self.active += 1
+            self._running.add(ticket)
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.in_use_mb -= cost_mb
+                self.active -= 1
+                self._running.discard(ticket)
+                self._cond.notify_all()
+    
+    def waiting(self):
+        return len(self._waiting)
+    
+    def position(self, ticket):
+        """1-based place in line, 0 once running, None for an unknown ticket."""
+        if ticket in self._running:
+            return 0
+        if ticket in self._waiting:
+            return self._waiting.index(ticket) + 1
+        return None
+    
+    def _fits(self, cost_mb):
+        return self.active == 0 or self.in_use_mb + cost_mb <= self.budget_mb
+
+
+ADMISSION = AdmissionController(ADMISSION_BUDGET_MB)
+
+
+def estimate_cost_mb(text, ref_audio_path):
+    """Estimate a request's peak memory from its text length and reference clip."""
+    seconds = len(text) / CHARS_PER_SECOND
+    if ref_audio_path is not None:
+        try:
+            seconds += sf.info(ref_audio_path).duration
+        except RuntimeError:
+            seconds += os.path.getsize(ref_audio_path) / (OUTPUT_SAMPLE_RATE * 2)
+    return MODEL_MB + seconds * MB_PER_AUDIO_SECOND
+
+
+def synthesize(text, ref_audio_path, ref_text, output_path):
+    repo_id = "ai4bharat/IndicF5"
+    model = AutoModel.from_pretrained(repo_id, trust_remote_code=True).to(device)
+    audio = model( text,ref_audio_path=ref_audio_path,ref_text=ref_text)
+
+    if isinstance(audio, np.ndarray) and audio.dtype == np.int16:
+        audio = audio.astype(np.float32) / 32768.0
+
+    sf.write(output_path, np.array(audio, dtype=np.float32), samplerate=OUTPUT_SAMPLE_RATE)
+
+
+def remove_files(*paths):
+    for path in paths:
+        if path is not None and os.path.exists(path):
+            os.remove(path)
 
 
 # -------------------------
@@ -24,27 +126,72 @@ app = FastAPI()
 
 
 @app.post("/generate/")
-async def generate_audio(text: str = Form(...),ref_text: str = Form(""),ref_audio: UploadFile = File(None)):
+async def generate_audio(text: str = Form(...),ref_text: str = Form(""),ref_audio: UploadFile = File(None),
+                         ticket: str = Form(None)):
+    """
+    Synthesize `text`, optionally in the voice of `ref_audio`.
+
+    `ticket` is an optional client-chosen id; while this request is queued,
+    GET /queue/?ticket=<id> reports its position.
+    """
+    if ADMISSION.waiting() >= MAX_QUEUE:
+        return JSONResponse({"status": "error", "message": "TTS queue is full",
+                             "queue_position": ADMISSION.waiting() + 1},
+                            status_code=503, headers={"Retry-After": "30"})
+    ticket = ticket or uuid.uuid4().hex
+    if ADMISSION.position(ticket) is not None:
+        return JSONResponse({"status": "error", "message": "Ticket already in use"}, status_code=409)
+
     ref_audio_path = None
     if ref_audio is not None:
         with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
             ref_audio_path = tmp.name
             tmp.write(await ref_audio.read())
 
-    repo_id = "ai4bharat/IndicF5"
-    model = AutoModel.from_pretrained(repo_id, trust_remote_code=True).to(device)
-    audio = model( text,ref_audio_path=ref_audio_path,ref_text=ref_text)
-
-    if isinstance(audio, np.ndarray) and audio.dtype == np.int16:
-        audio = audio.astype(np.float32) / 32768.0
+    # Each request writes its own file so concurrent requests do not overwrite each other
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
+        output_path = tmp.name
 
-    output_path = "output.wav"
-    sf.write(output_path, np.array(audio, dtype=np.float32), samplerate=24000)
+    queued_at = time.time()
+    arrival_position = ADMISSION.waiting() + 1
+    try:
+        async with ADMISSION.admit(ticket, estimate_cost_mb(text, ref_audio_path)):
+            waited = time.time() - queued_at
+            await run_in_threadpool(synthesize, text, ref_audio_path, ref_text, output_path)
+    except BaseException:
+        remove_files(ref_audio_path, output_path)
+        raise
 
     # Return file
-    return FileResponse(output_path, media_type="audio/wav", filename="output.wav")
+    return FileResponse(output_path, media_type="audio/wav", filename="output.wav",
+                        headers={"X-Queue-Ticket": ticket, "X-Queue-Position": str(arrival_position),
+                                 "X-Queue-Wait": f"{waited:.2f}"},
+                        background=BackgroundTask(remove_files, ref_audio_path, output_path))
+
+
+@app.get("/queue/")
+async def queue_status(ticket: str = None):
+    """
+    Requests waiting and running, and the memory they have reserved.
+    
+    With `ticket` (as sent to /generate/) also the request's queue_position:
+    its place in line, or 0 once running. Unknown tickets (not yet uploaded,
+    or finished) get a 404.
+    """
+    status = {
+        "waiting": ADMISSION.waiting(),
+        "running": ADMISSION.active,
+        "in_use_mb": round(ADMISSION.in_use_mb, 1),
+        "budget_mb": ADMISSION.budget_mb,
+    }
+    if ticket is not None:
+        position = ADMISSION.position(ticket)
+        if position is None:
+            return JSONResponse({**status, "ticket": ticket, "message": "Unknown ticket"}, status_code=404)
+        status.update(ticket=ticket, queue_position=position)
+    return status
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("server:app", host="0.0.0.0", port=8005)
\ No newline at end of file
+    uvicorn.run("server:app", host="0.0.0.0", port=8005)
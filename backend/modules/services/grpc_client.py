@@ -1,21 +1,147 @@
 import grpc
+import os
+import struct
+import tempfile
+import threading
+import itertools
+import time
 from . import media_pb2 as pb2
 from . import media_pb2_grpc as pb2_grpc
 
 # Safe chunk size (4 MB)
 CHUNK_SIZE = 4 * 1024 * 1024
 
+# Comma-separated media service endpoints, used round-robin
+MEDIA_SERVERS = [t.strip() for t in os.environ.get("MEDIA_SERVERS", "172.16.2.131:8004").split(",") if t.strip()]
+HEALTH_INTERVAL = 10  # seconds between background health probes
+HEALTH_TIMEOUT = 5  # seconds per HealthCheck RPC
 
-def video_stream(video_bytes):
+CHANNEL_OPTIONS = [
+    ("grpc.enable_http_proxy", 0),
+    # Keep idle connections open so requests skip connection setup
+    ("grpc.keepalive_time_ms", 60000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+
+class MediaChannelPool:
+    """
+    One long-lived channel and stub per media server, shared by all requests
+    
+    A daemon thread calls HealthCheck on every server each HEALTH_INTERVAL
+    seconds; is_alive() and pick() only read the cached result. Requests are
+    spread round-robin over the servers that passed their last probe.
+    """
+    
+    def __init__(self, targets, interval=HEALTH_INTERVAL):
+        self._targets = list(targets)
+        self._interval = interval
+        self._stubs = {}
+        self._healthy = dict.fromkeys(self._targets, False)
+        self._probed = threading.Event()
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._prober = None
+    
+    def stub(self, target):
+        with self._lock:
+            if target not in self._stubs:
+                channel = grpc.insecure_channel(target, options=CHANNEL_OPTIONS)
+                self._stubs[target] = pb2_grpc.MediaServiceStub(channel)
+            return self._stubs[target]
+    
+    def start(self):
+        """Start the health prober (once per process, on first use)."""
+        with self._lock:
+            if self._prober is not None:
+                return
+            self._prober = threading.Thread(target=self._probe_forever, name="media-health", daemon=True)
+            self._prober.start()
+    
+    def probe(self):
+        for target in self._targets:
+            try:
+                resp = self.stub(target).HealthCheck(pb2.Empty(), timeout=HEALTH_TIMEOUT)
+                healthy = resp.status == "OK"
+            except grpc.RpcError as e:
+                if self._healthy[target]:
+                    print(f"❌ gRPC health check failed for {target}: {e.code()}")
+                healthy = False
+            self._healthy[target] = healthy
+        self._probed.set()
+    
+    def _probe_forever(self):
+        while True:
+            self.probe()
+            time.sleep(self._interval)
+    
+    def healthy_targets(self):
+        return [target for target in self._targets if self._healthy[target]]
+    
+    def is_alive(self):
+        """Whether any server passed its last probe; only the very first call waits for a probe."""
+        self.start()
+        self._probed.wait(HEALTH_TIMEOUT * len(self._targets))
+        return bool(self.healthy_targets())
+    
+    def pick(self):
+        """Next (target, stub) in round-robin order, preferring healthy servers."""
+        self.start()
+        targets = self.healthy_targets() or self._targets
+        target = targets[next(self._turn) % len(targets)]
+        return target, self.stub(target)
+    
+    def mark_down(self, target):
+        """Take a server out of rotation until its next successful probe."""
+        self._healthy[target] = False
+
+
+MEDIA_POOL = MediaChannelPool(MEDIA_SERVERS)
+
+
+def video_size(video):
+    """Size in bytes of bytes, an UploadedFile or a seekable file, or None."""
+    if hasattr(video, "size"):
+        return video.size
+    if hasattr(video, "read"):
+        try:
+            return os.fstat(video.fileno()).st_size
+        except (AttributeError, OSError):
+            return None
+    return len(video)
+
+
+def video_pieces(video):
+    """
+    Yield the video in pieces of at most CHUNK_SIZE without reading it whole
+    
+    Django UploadedFiles are read through chunks() (from their temp file for
+    large uploads), other file objects with read(); bytes are sliced.
+    """
+    if hasattr(video, "chunks"):
+        yield from video.chunks(CHUNK_SIZE)
+    elif hasattr(video, "read"):
+        while True:
+            data = video.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+    else:
+        for i in range(0, len(video), CHUNK_SIZE):
+            yield video[i:i + CHUNK_SIZE]
+
+
+def video_stream(video):
     """
     Generator that yields VideoChunk messages (streaming)
-    Breaks large video into 4MB pieces
+    Breaks large video into 4MB pieces, pulled from `video` only as gRPC sends them
     """
-    total_size = len(video_bytes)
+    total_size = video_size(video)
     sent = 0
     
-    for i in range(0, total_size, CHUNK_SIZE):
-        chunk_data = video_bytes[i:i + CHUNK_SIZE]
+    for chunk_data in video_pieces(video):
         sent += len(chunk_data)
         print(f"📤 Sending chunk: {len(chunk_data)} bytes ({sent}/{total_size})")
         
@@ -25,6 +151,79 @@ def video_stream(video_bytes):
     print(f"✅ All chunks sent: {sent} bytes")
 
 
+def wav_header(n_bytes, sample_rate):
+    """44-byte header for `n_bytes` of 16-bit mono PCM."""
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + n_bytes, b"WAVE",
+                       b"fmt ", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+                       b"data", n_bytes)
+
+
+def stream_audio_via_grpc(video_bytes):
+    """
+    Extract audio from video via the StreamAudio RPC
+    
+    Args:
+        video_bytes: bytes or file-like object (Django UploadedFile)
+    
+    Yields:
+        (pcm_bytes, sample_rate) per AudioChunk (16-bit mono PCM)
+    
+    Chunks are pulled from the server only as fast as the caller consumes
+    them; gRPC flow control holds the server (and its ffmpeg) back meanwhile.
+    The video is uploaded piece by piece and never read into memory whole.
+    """
+    size = video_size(video_bytes)
+    if size is not None:
+        print(f"📹 Video size: {size} bytes ({size / (1024**3):.2f} GB)")
+
+    # Pooled channel; audio chunks fit the default message size limits
+    target, stub = MEDIA_POOL.pick()
+    responses = stub.StreamAudio(video_stream(video_bytes))
+
+    try:
+        print(f"🚀 Starting streaming upload to {target}...")
+        for chunk in responses:
+            yield chunk.data, chunk.sample_rate
+        
+    except grpc.RpcError as e:
+        print(f"❌ gRPC Error: {e.code()} - {e.details()}")
+        if e.code() == grpc.StatusCode.UNAVAILABLE:
+            MEDIA_POOL.mark_down(target)
+        raise
+    finally:
+        # Stops the server side too if the caller gave up early
+        responses.cancel()
+
+
+def extract_audio_to_file(video_bytes):
+    """
+    Extract audio from video into a temporary WAV file
+    
+    Audio is written chunk by chunk as it arrives, so it never sits fully in
+    memory. The caller owns (and must remove) the returned file.
+    
+    Returns:
+        (path, audio_bytes): WAV file path and its PCM payload size
+    """
+    fd, path = tempfile.mkstemp(suffix=".wav")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(wav_header(0, 16000))  # rewritten once the size is known
+            total = 0
+            sample_rate = 16000
+            for data, sample_rate in stream_audio_via_grpc(video_bytes):
+                f.write(data)
+                total += len(data)
+            f.seek(0)
+            f.write(wav_header(total, sample_rate))
+    except BaseException:
+        os.remove(path)
+        raise
+    
+    print(f"✅ Received audio: {total} bytes")
+    return path, total
+
+
 def extract_audio_via_grpc(video_bytes):
     """
     Extract audio from video via gRPC streaming
@@ -35,56 +234,42 @@ def extract_audio_via_grpc(video_bytes):
     Returns:
         bytes: Extracted audio data (WAV format)
     """
-    # Read file if file-like object (Django UploadedFile)
-    if hasattr(video_bytes, "read"):
-        print("📖 Reading from file-like object...")
-        video_bytes = video_bytes.read()
-    
-    print(f"📹 Video size: {len(video_bytes)} bytes ({len(video_bytes) / (1024**3):.2f} GB)")
-
-    channel = grpc.insecure_channel(
-        "172.16.2.131:8004",
-        options=[
-            ("grpc.max_send_message_length", -1),
-            ("grpc.max_receive_message_length", -1),
-        ]
-    )
+    path, _ = extract_audio_to_file(video_bytes)
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(path)
 
-    stub = pb2_grpc.MediaServiceStub(channel)
 
+def extract_audio_to_artifact(video_bytes):
+    """
+    Extract audio from video into the artifact directory shared by the media
+    and STT services
+    
+    The audio stays on the media side; pass the returned id to the STT
+    service as `audio_ref`. Every server in MEDIA_SERVERS must share that
+    directory with the STT service.
+    
+    Returns:
+        (artifact_id, size): artifact id and WAV size in bytes (0 if no audio)
+    """
+    target, stub = MEDIA_POOL.pick()
     try:
-        print("🚀 Starting streaming upload...")
-        # ✅ STREAMING CALL: Pass generator to ExtractAudio
-        response = stub.ExtractAudio(video_stream(video_bytes))
-        
-        print(f"✅ Received audio: {len(response.audio_data)} bytes")
-        return response.audio_data
-        
+        print(f"🚀 Starting streaming upload to {target}...")
+        artifact = stub.ExtractAudioArtifact(video_stream(video_bytes))
     except grpc.RpcError as e:
         print(f"❌ gRPC Error: {e.code()} - {e.details()}")
+        if e.code() == grpc.StatusCode.UNAVAILABLE:
+            MEDIA_POOL.mark_down(target)
         raise
-    finally:
-        channel.close()
+    
+    print(f"✅ Audio artifact {artifact.artifact_id}: {artifact.size_bytes} bytes")
+    return artifact.artifact_id, artifact.size_bytes
 
 
 def is_grpc_alive():
     """
-    Check if gRPC server is alive
+    Check if gRPC server is alive (cached result of the background prober)
     """
-    channel = None
-    try:
-        channel = grpc.insecure_channel(
-            "172.16.2.131:8004",
-            options=[
-                ('grpc.enable_http_proxy', 0),
-            ]
-        )
-        stub = pb2_grpc.MediaServiceStub(channel)
-        resp = stub.HealthCheck(pb2.Empty(), timeout=5)
-        return resp.status == "OK"
-    except Exception as e:
-        print(f"❌ gRPC health check failed: {e}")
-        return False
-    finally:
-        if channel:
-            channel.close()
\ No newline at end of file
+    return MEDIA_POOL.is_alive()
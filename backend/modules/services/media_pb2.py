@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0bmedia.proto\x12\x05media\"\x07\n\x05\x45mpty\"\x1a\n\nVideoChunk\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\"#\n\rAudioResponse\x12\x12\n\naudio_data\x18\x01 \x01(\x0c\"\x1e\n\x0cHealthStatus\x12\x0e\n\x06status\x18\x01 \x01(\t2{\n\x0cMediaService\x12\x39\n\x0c\x45xtractAudio\x12\x11.media.VideoChunk\x1a\x14.media.AudioResponse(\x01\x12\x30\n\x0bHealthCheck\x12\x0c.media.Empty\x1a\x13.media.HealthStatusb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0bmedia.proto\x12\x05media\"\x07\n\x05\x45mpty\"\x1a\n\nVideoChunk\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\"#\n\rAudioResponse\x12\x12\n\naudio_data\x18\x01 \x01(\x0c\"/\n\nAudioChunk\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\x12\x13\n\x0bsample_rate\x18\x02 \x01(\x05\"8\n\rAudioArtifact\x12\x13\n\x0b\x61rtifact_id\x18\x01 \x01(\t\x12\x12\n\nsize_bytes\x18\x02 \x01(\x03\"\x1e\n\x0cHealthStatus\x12\x0e\n\x06status\x18\x01 \x01(\t2\xf7\x01\n\x0cMediaService\x12\x39\n\x0c\x45xtractAudio\x12\x11.media.VideoChunk\x1a\x14.media.AudioResponse(\x01\x12\x37\n\x0bStreamAudio\x12\x11.media.VideoChunk\x1a\x11.media.AudioChunk(\x01\x30\x01\x12\x41\n\x14\x45xtractAudioArtifact\x12\x11.media.VideoChunk\x1a\x14.media.AudioArtifact(\x01\x12\x30\n\x0bHealthCheck\x12\x0c.media.Empty\x1a\x13.media.HealthStatusb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -37,8 +37,12 @@ if not _descriptor._USE_C_DESCRIPTORS:
   _globals['_VIDEOCHUNK']._serialized_end=57
   _globals['_AUDIORESPONSE']._serialized_start=59
   _globals['_AUDIORESPONSE']._serialized_end=94
-  _globals['_HEALTHSTATUS']._serialized_start=96
-  _globals['_HEALTHSTATUS']._serialized_end=126
-  _globals['_MEDIASERVICE']._serialized_start=128
-  _globals['_MEDIASERVICE']._serialized_end=251
+  _globals['_AUDIOCHUNK']._serialized_start=96
+  _globals['_AUDIOCHUNK']._serialized_end=143
+  _globals['_AUDIOARTIFACT']._serialized_start=145
+  _globals['_AUDIOARTIFACT']._serialized_end=201
+  _globals['_HEALTHSTATUS']._serialized_start=203
+  _globals['_HEALTHSTATUS']._serialized_end=233
+  _globals['_MEDIASERVICE']._serialized_start=236
+  _globals['_MEDIASERVICE']._serialized_end=483
 # @@protoc_insertion_point(module_scope)
@@ -39,6 +39,16 @@ class MediaServiceStub(object):
                 request_serializer=media__pb2.VideoChunk.SerializeToString,
                 response_deserializer=media__pb2.AudioResponse.FromString,
                 _registered_method=True)
+        self.StreamAudio = channel.stream_stream(
+                '/media.MediaService/StreamAudio',
+                request_serializer=media__pb2.VideoChunk.SerializeToString,
+                response_deserializer=media__pb2.AudioChunk.FromString,
+                _registered_method=True)
+        self.ExtractAudioArtifact = channel.stream_unary(
+                '/media.MediaService/ExtractAudioArtifact',
+                request_serializer=media__pb2.VideoChunk.SerializeToString,
+                response_deserializer=media__pb2.AudioArtifact.FromString,
+                _registered_method=True)
         self.HealthCheck = channel.unary_unary(
                 '/media.MediaService/HealthCheck',
                 request_serializer=media__pb2.Empty.SerializeToString,
@@ -55,6 +65,21 @@ class MediaServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def StreamAudio(self, request_iterator, context):
+        """Audio as 16-bit mono PCM chunks, sent while ffmpeg is still decoding
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def ExtractAudioArtifact(self, request_iterator, context):
+        """Audio written as a WAV to the directory shared with the STT service;
+        only its id comes back, for the STT service to pick up
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def HealthCheck(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -69,6 +94,16 @@ def add_MediaServiceServicer_to_server(servicer, server):
                     request_deserializer=media__pb2.VideoChunk.FromString,
                     response_serializer=media__pb2.AudioResponse.SerializeToString,
             ),
+            'StreamAudio': grpc.stream_stream_rpc_method_handler(
+                    servicer.StreamAudio,
+                    request_deserializer=media__pb2.VideoChunk.FromString,
+                    response_serializer=media__pb2.AudioChunk.SerializeToString,
+            ),
+            'ExtractAudioArtifact': grpc.stream_unary_rpc_method_handler(
+                    servicer.ExtractAudioArtifact,
+                    request_deserializer=media__pb2.VideoChunk.FromString,
+                    response_serializer=media__pb2.AudioArtifact.SerializeToString,
+            ),
             'HealthCheck': grpc.unary_unary_rpc_method_handler(
                     servicer.HealthCheck,
                     request_deserializer=media__pb2.Empty.FromString,
@@ -112,6 +147,60 @@ class MediaService(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def StreamAudio(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(
+            request_iterator,
+            target,
+            '/media.MediaService/StreamAudio',
+            media__pb2.VideoChunk.SerializeToString,
+            media__pb2.AudioChunk.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def ExtractAudioArtifact(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(
+            request_iterator,
+            target,
+            '/media.MediaService/ExtractAudioArtifact',
+            media__pb2.VideoChunk.SerializeToString,
+            media__pb2.AudioArtifact.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def HealthCheck(request,
             target,
@@ -3,5 +3,6 @@ from . import views
 urlpatterns = [
     path('',views.index),
     path('video_transcribe/',views.video_transcribe),
+    path('video_transcribe_stream/',views.video_transcribe_stream),
     path('stt/',views.stt),
 ]
\ No newline at end of file
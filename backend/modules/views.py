@@ -1,14 +1,97 @@
 from django.shortcuts import render
-from .services.grpc_client import extract_audio_via_grpc, is_grpc_alive
-from django.http import JsonResponse,HttpResponse
+from .services.grpc_client import extract_audio_to_file, extract_audio_to_artifact, is_grpc_alive
+from django.http import JsonResponse,HttpResponse,StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from modules.models import Transcript
 import requests
 import traceback
 import uuid
+import time
+import json
+import os
 
-audio_to_trans = "http://172.16.2.131:8003/process_audio/"
+stt_jobs = "http://172.16.2.131:8003/jobs/"
+STT_POLL_INTERVAL = 2  # seconds between job status polls
+STT_TIMEOUT = 3000  # give up on a job after this many seconds
 speech_to_text = "http://172.16.2.131:8005/generate/"
+# "artifact": the media service leaves the extracted audio where the STT service
+# picks it up (same container or shared volume) and only its id passes through
+# here; "upload": the audio is downloaded here and re-uploaded to the STT service
+AUDIO_HANDOFF = os.environ.get("STT_AUDIO_HANDOFF", "artifact")
+
+def post_stt_job(files, data):
+    """Queue audio (a file, or an audio_ref in `data`) on the STT service."""
+    return requests.post(stt_jobs, files=files, data=data, timeout=300)
+
+def run_stt_job(files, data):
+    """
+    Submit audio to the STT job queue and poll until it finishes.
+    
+    Returns the response of the job's result endpoint.
+    """
+    response = post_stt_job(files, data)
+    if response.status_code != 200:
+        return response
+    job = response.json()
+    if "job_id" not in job:
+        return response
+    
+    job_id = job["job_id"]
+    print(f"STT job queued: {job_id} (position {job.get('queue_position')})")
+    deadline = time.time() + STT_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(STT_POLL_INTERVAL)
+        result = requests.get(f"{stt_jobs}{job_id}/result/", timeout=60)
+        if result.status_code != 202:
+            return result
+    raise requests.exceptions.Timeout(f"STT job {job_id} did not finish in {STT_TIMEOUT}s")
+
+def relay_stt_events(job_id):
+    """
+    Relay the STT job's server-sent events line by line.
+    
+    The final "done" event carries the full result, which is stored as a
+    Transcript like the blocking endpoint does.
+    """
+    event = None
+    with requests.get(f"{stt_jobs}{job_id}/events/", stream=True, timeout=(10, STT_TIMEOUT)) as response:
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: ") and event == "done":
+                result = json.loads(line[len("data: "):])
+                Transcript.objects.create(
+                    transcript_id=str(uuid.uuid4()),
+                    transcript_text=result.get("only_transcript"),
+                    source_lan=result.get("source_lan")
+                )
+            yield f"{line}\n"
+
+def submit_video_audio(video, data, submit):
+    """
+    Extract the video's audio and hand it to `submit(files, data)`.
+    
+    Returns what `submit` returns, or None when no audio was extracted.
+    """
+    if AUDIO_HANDOFF == "artifact":
+        audio_ref, audio_size = extract_audio_to_artifact(video)
+        if not audio_size:
+            return None
+        print(f"Audio extracted: {audio_size} bytes (artifact {audio_ref})")
+        return submit(None, {**data, "audio_ref": audio_ref})
+    
+    audio_path, audio_size = extract_audio_to_file(video)
+    try:
+        if not audio_size:
+            return None
+        print(f"Audio extracted: {audio_size} bytes")
+        with open(audio_path, "rb") as audio:
+            files = {
+                "file": ("audio.wav", audio, "audio/wav")
+            }
+            return submit(files, data)
+    finally:
+        os.remove(audio_path)
 
 def index(request):
     return JsonResponse({"message": "success"})
@@ -36,24 +119,15 @@ def video_transcribe(request):
         print("gRPC server is alive")
         
      
-        print("Extract audio")
-        audio = extract_audio_via_grpc(video)
-        
-        if not audio:
-            return JsonResponse({"error": "Failed to extract audio"}, status=500)
-        
-        print(f"Audio extracted: {len(audio)} bytes")
-        
-        files = {
-            "file": ("audio.wav", audio, "audio/wav")
-        }
+        print("Extract audio and send to STT service")
         data = {
-            "source_lan": source_lan
+            "source_lan": source_lan,
+            # json_data below needs the full per-word json; srt is the default
+            "formats": "srt,json"
         }
-        
-
-        print("Sending to STT service")
-        response = requests.post(audio_to_trans, files=files, data=data, timeout=3000)
+        response = submit_video_audio(video, data, run_stt_job)
+        if response is None:
+            return JsonResponse({"error": "Failed to extract audio"}, status=500)
         
         
         if response.status_code != 200:
@@ -104,6 +178,50 @@ def video_transcribe(request):
             "details": str(e)
         }, status=500)
 @csrf_exempt
+def video_transcribe_stream(request):
+    """Same as video_transcribe, but streams partial transcripts as server-sent events."""
+    if request.method != "POST":
+        return JsonResponse({"error": "send in POST method"}, status=400)
+    
+    video = request.FILES.get("video_file")
+    source_lan = request.POST.get("source_lan", "auto")
+    if not video:
+        return JsonResponse({"error": "video not received"}, status=400)
+    
+    try:
+        if not is_grpc_alive():
+            return JsonResponse({"error": "gRPC server is not available"}, status=503)
+        
+        response = submit_video_audio(video, {"source_lan": source_lan}, post_stt_job)
+        if response is None:
+            return JsonResponse({"error": "Failed to extract audio"}, status=500)
+        job = response.json()
+        if response.status_code != 200 or "job_id" not in job:
+            return JsonResponse({
+                "error": f"STT service returned error: {response.status_code}",
+                "details": response.text
+            }, status=500)
+        
+        stream = StreamingHttpResponse(relay_stt_events(job["job_id"]), content_type="text/event-stream")
+        stream["Cache-Control"] = "no-cache"
+        stream["X-Accel-Buffering"] = "no"
+        return stream
+    
+    except requests.exceptions.ConnectionError as e:
+        traceback.print_exc()
+        return JsonResponse({
+            "error": "Cannot connect to STT service",
+            "details": str(e)
+        }, status=503)
+    
+    except Exception as e:
+        traceback.print_exc()
+        return JsonResponse({
+            "error": "Internal server error",
+            "details": str(e)
+        }, status=500)
+
+@csrf_exempt
 def stt(request):
     if request.method != "POST":
         return JsonResponse({"error": "send in POST method"}, status=400)